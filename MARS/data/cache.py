@@ -0,0 +1,60 @@
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+
+
+"""Helpers for content-addressed caches, so that structures which are expensive to build from the dataset
+files are only computed once for every unique combination of inputs
+"""
+
+# bump this whenever the layout of a cached structure changes, so that stale caches are not re-used
+CACHE_VERSION = 5
+
+
+def cache_key(files=(), objects=(), arrays=()):
+    """Hashes the contents of some files, some JSON-serializable objects and some arrays into a short hex key
+    :param files: paths of the files whose contents should be part of the key
+    :param objects: other inputs (vocabularies, parameters) which should be part of the key
+    :param arrays: NumPy arrays (e.g., of an already built graph) which should be part of the key
+    """
+    hasher = hashlib.sha256(f'v{CACHE_VERSION}'.encode())
+    for path in files:
+        with open(path, 'rb') as raw_file:
+            for chunk in iter(lambda: raw_file.read(1 << 20), b''):
+                hasher.update(chunk)
+    for obj in objects:
+        hasher.update(json.dumps(obj, sort_keys=True, default=str).encode())
+    for array in arrays:
+        hasher.update(f'{array.dtype.str}{array.shape}'.encode())
+        hasher.update(np.ascontiguousarray(array))
+    return hasher.hexdigest()[:16]
+
+
+def save_arrays(path, arrays):
+    """Writes a dictionary of arrays as raw .npy files into a directory, so each can be memory-mapped on load.
+    The directory is written under a temporary name first, so concurrent runs never read a partial cache.
+    """
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    os.makedirs(tmp_path)
+    for key, array in arrays.items():
+        np.save(os.path.join(tmp_path, f'{key}.npy'), array)
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # another run wrote the same cache in the meantime; its contents are identical, so keep that one
+        shutil.rmtree(tmp_path)
+
+
+def load_arrays(path, mmap_mode='r'):
+    """Reads back a dictionary of arrays written by save_arrays.
+    By default, the arrays are read-only memory maps: they are loaded lazily, page by page, and all processes
+        which open the same cache share one physical copy through the page cache.
+    """
+    arrays = dict()
+    for file_name in os.listdir(path):
+        if file_name.endswith('.npy'):
+            # np.asarray drops the np.memmap subclass, but keeps the file-backed buffer
+            arrays[file_name[:-len('.npy')]] = np.asarray(np.load(os.path.join(path, file_name), mmap_mode=mmap_mode))
+    return arrays
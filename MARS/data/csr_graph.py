@@ -0,0 +1,252 @@
+import numpy as np
+
+
+"""A compressed-sparse-row (CSR) store of the KG, in which the outgoing edges of each source node
+are kept as one contiguous slice of NumPy arrays instead of as networkx node and edge objects
+"""
+
+
+class CSRGraph(object):
+    def __init__(self, indptr, neighbors, relations, node_mask=None):
+        """Wraps already sorted CSR arrays.
+            :param indptr: array of length num_nodes + 1; the edges of source node i are indptr[i]:indptr[i + 1]
+            :param neighbors: array holding the target node of each edge
+            :param relations: array holding the relation ID of each edge
+            :param node_mask: (optional) boolean array marking which node IDs are part of the graph;
+                by default, every node with at least one incoming or outgoing edge
+        """
+        self.indptr = indptr
+        self.neighbors = neighbors
+        self.relations = relations
+        self.num_nodes = indptr.shape[0] - 1
+        if node_mask is None:
+            node_mask = self.degree() > 0
+        self.node_mask = node_mask
+        # the edge IDs sorted by relation, and the offsets of each relation's slice in them;
+        # built on the first call of build_relation_index
+        self.relation_order = None
+        self.relation_indptr = None
+
+    @classmethod
+    def from_edges(cls, sources, relations, targets, num_nodes, node_mask=None):
+        """Builds the CSR arrays from parallel arrays of edges.
+        The edges of each source node keep the order in which they were given.
+            :param sources: array of source node IDs
+            :param relations: array of relation IDs
+            :param targets: array of target node IDs
+            :param num_nodes: the number of node IDs (i.e., the size of the entity vocab)
+            :param node_mask: (optional) boolean array marking which node IDs are part of the graph
+        """
+        sources = np.asarray(sources, dtype=np.int64)
+        order = np.argsort(sources, kind='stable')
+        counts = np.bincount(sources, minlength=num_nodes)
+        indptr = np.zeros(num_nodes + 1, dtype=np.int64)
+        np.cumsum(counts, out=indptr[1:])
+        neighbors = np.asarray(targets, dtype=np.int32)[order]
+        relations = np.asarray(relations, dtype=np.int32)[order]
+        return cls(indptr, neighbors, relations, node_mask)
+
+    @classmethod
+    def from_networkx(cls, nx_graph, num_nodes):
+        """Builds the CSR arrays from a networkx (Multi)DiGraph whose edges carry a 'type' attribute"""
+        edges = list(nx_graph.edges(data='type'))
+        sources = np.array([edge[0] for edge in edges], dtype=np.int64)
+        targets = np.array([edge[1] for edge in edges], dtype=np.int64)
+        relations = np.array([edge[2] for edge in edges], dtype=np.int64)
+        node_mask = np.zeros(num_nodes, dtype=bool)
+        node_mask[np.fromiter(nx_graph.nodes(), dtype=np.int64)] = True
+        return cls.from_edges(sources, relations, targets, num_nodes, node_mask)
+
+    @classmethod
+    def from_arrays(cls, arrays, prefix):
+        """Re-creates a graph, with its relation index, from the dictionary of arrays written by to_arrays"""
+        graph = cls(arrays[f'{prefix}_indptr'], arrays[f'{prefix}_neighbors'], arrays[f'{prefix}_relations'],
+                    arrays[f'{prefix}_node_mask'])
+        graph.relation_order = arrays[f'{prefix}_relation_order']
+        graph.relation_indptr = arrays[f'{prefix}_relation_indptr']
+        return graph
+
+    def to_arrays(self, prefix):
+        """Returns the CSR arrays and the relation index as a dictionary,
+        with keys prefixed so several graphs can share one file
+        """
+        self.build_relation_index()
+        return {f'{prefix}_indptr': self.indptr, f'{prefix}_neighbors': self.neighbors,
+                f'{prefix}_relations': self.relations, f'{prefix}_node_mask': self.node_mask,
+                f'{prefix}_relation_order': self.relation_order, f'{prefix}_relation_indptr': self.relation_indptr}
+
+    def to_networkx(self):
+        """Exports the graph as a networkx MultiDiGraph, with the relation IDs as the edge 'type' attribute"""
+        import networkx as nx
+        nx_graph = nx.MultiDiGraph()
+        nx_graph.add_nodes_from(self.nodes().tolist())
+        nx_graph.add_edges_from((int(e1), int(e2), {'type': int(r)}) for e1, r, e2 in
+                                zip(self.sources(), self.relations, self.neighbors))
+        return nx_graph
+
+    def __contains__(self, node):
+        return bool(self.node_mask[node])
+
+    def __len__(self):
+        return int(self.node_mask.sum())
+
+    def nodes(self):
+        """Returns an array of all node IDs in the graph"""
+        return np.nonzero(self.node_mask)[0]
+
+    def number_of_edges(self):
+        return self.neighbors.shape[0]
+
+    def sources(self):
+        """Returns the source node of each edge, parallel to self.neighbors and self.relations"""
+        return np.repeat(np.arange(self.num_nodes), self.out_degree())
+
+    def out_degree(self, node=None):
+        """Gets the number of outgoing edges of one node, or of all nodes if none is given"""
+        if node is None:
+            return np.diff(self.indptr)
+        return int(self.indptr[node + 1] - self.indptr[node])
+
+    def in_degree(self):
+        return np.bincount(self.neighbors, minlength=self.num_nodes)
+
+    def degree(self):
+        return self.out_degree() + self.in_degree()
+
+    def edges_of(self, node):
+        """Returns the (targets, relations) of the outgoing edges of a node as zero-copy views"""
+        start, end = self.indptr[node], self.indptr[node + 1]
+        return self.neighbors[start:end], self.relations[start:end]
+
+    def successors(self, node):
+        """Returns the unique target nodes of a node's outgoing edges"""
+        return np.unique(self.edges_of(node)[0])
+
+    def edge_ids_of(self, nodes):
+        """Returns the indices of all outgoing edges of the given nodes, concatenated"""
+        starts = self.indptr[nodes]
+        counts = self.indptr[np.asarray(nodes) + 1] - starts
+        shifts = np.repeat(starts - (np.cumsum(counts) - counts), counts)
+        return np.arange(counts.sum()) + shifts
+
+    def sources_of(self, edge_ids):
+        """Returns the source node of each of the given (sorted or unsorted) edge IDs"""
+        return np.searchsorted(self.indptr, edge_ids, side='right') - 1
+
+    def build_relation_index(self):
+        """Partitions the edge IDs by relation, so that the edges of one relation are a contiguous slice
+        of self.relation_order, from self.relation_indptr[r] to self.relation_indptr[r + 1].
+        Within each slice, the edge IDs stay in increasing order.
+        """
+        if self.relation_order is None:
+            counts = np.bincount(self.relations) if self.relations.shape[0] > 0 else np.zeros(0, dtype=np.int64)
+            self.relation_indptr = np.zeros(counts.shape[0] + 1, dtype=np.int64)
+            np.cumsum(counts, out=self.relation_indptr[1:])
+            self.relation_order = np.argsort(self.relations, kind='stable')
+
+    def relation_edge_ids(self, edge_type):
+        """Returns the IDs of all edges of one relation as a zero-copy view into the relation index"""
+        self.build_relation_index()
+        if edge_type >= self.relation_indptr.shape[0] - 1:
+            return self.relation_order[:0]
+        return self.relation_order[self.relation_indptr[edge_type]:self.relation_indptr[edge_type + 1]]
+
+    def edge_subgraph(self, edge_mask):
+        """Returns a new graph keeping only the edges where edge_mask is True.
+        Like removing edges in networkx, the set of nodes stays the same.
+        """
+        counts = np.bincount(self.sources()[edge_mask], minlength=self.num_nodes)
+        indptr = np.zeros(self.num_nodes + 1, dtype=np.int64)
+        np.cumsum(counts, out=indptr[1:])
+        return CSRGraph(indptr, self.neighbors[edge_mask], self.relations[edge_mask], self.node_mask.copy())
+
+    def edge_id_subgraph(self, edge_ids):
+        """Like edge_subgraph, but keeps the edges with the given sorted IDs, without a pass over all edges"""
+        counts = np.bincount(self.sources_of(edge_ids), minlength=self.num_nodes)
+        indptr = np.zeros(self.num_nodes + 1, dtype=np.int64)
+        np.cumsum(counts, out=indptr[1:])
+        return CSRGraph(indptr, self.neighbors[edge_ids], self.relations[edge_ids], self.node_mask.copy())
+
+    def relation_subgraph(self, edge_types):
+        """Given a set of edge types, returns a graph containing only those edges and the nodes they touch.
+        The edges are gathered from the relation index, so the cost depends on the size of the subgraph only.
+        """
+        edge_ids = [self.relation_edge_ids(edge_type) for edge_type in edge_types]
+        edge_ids = np.sort(np.concatenate(edge_ids)) if edge_ids else np.zeros(0, dtype=np.int64)
+        sub_graph = self.edge_id_subgraph(edge_ids)
+        sub_graph.remove_isolated_nodes()
+        return sub_graph
+
+    def remove_isolated_nodes(self):
+        self.node_mask = self.node_mask & (self.degree() > 0)
+
+    def edge_counter(self):
+        """Gets a dictionary counting the edges of each relation ID, read off the relation index"""
+        self.build_relation_index()
+        counts = np.diff(self.relation_indptr)
+        rel_ids = np.nonzero(counts)[0]
+        return dict(zip(rel_ids.tolist(), counts[rel_ids].tolist()))
+
+    def shortest_path_length(self, source, target, cutoff=None):
+        """Breadth-first search over the CSR arrays, expanding the whole frontier at once.
+            :param source: the node from which to start
+            :param target: the node to reach
+            :param cutoff: (optional) the maximum depth to search
+        :returns: the length of the shortest path, or None if there is none (within the cutoff)
+        """
+        if source == target:
+            return 0
+        visited = np.zeros(self.num_nodes, dtype=bool)
+        visited[source] = True
+        frontier = np.array([source])
+        depth = 0
+        while frontier.size > 0 and (cutoff is None or depth < cutoff):
+            depth += 1
+            reached = self.neighbors[self.edge_ids_of(frontier)]
+            reached = reached[~visited[reached]]
+            if np.any(reached == target):
+                return depth
+            visited[reached] = True
+            frontier = np.unique(reached)
+        return None
+
+    def reachable(self, sources, targets, cutoff=None, block_size=256):
+        """Checks for many (source, target) pairs at once whether the target can be reached from the source.
+        The pairs are grouped by source node, and one breadth-first search is run per unique source; blocks of sources
+            are searched together, with one row of a visited matrix per source in the block.
+            :param sources: array of source nodes
+            :param targets: array of target nodes, parallel to sources
+            :param cutoff: (optional) the maximum path length
+            :param block_size: the number of sources which are searched together
+        :returns: a boolean array, which is True for the pairs with a path of length <= cutoff;
+            like shortest_path_length, each node reaches itself
+        """
+        sources = np.asarray(sources, dtype=np.int64)
+        targets = np.asarray(targets, dtype=np.int64)
+        found = np.zeros(sources.shape[0], dtype=bool)
+        unique_sources, source_rows = np.unique(sources, return_inverse=True)
+        # the pairs sorted by source, so each block of unique sources maps to one contiguous slice of pairs
+        pair_order = np.argsort(source_rows, kind='stable')
+        pair_bounds = np.searchsorted(source_rows[pair_order], np.arange(0, unique_sources.shape[0] + block_size,
+                                                                         block_size))
+        for block, block_start in enumerate(range(0, unique_sources.shape[0], block_size)):
+            block_sources = unique_sources[block_start:block_start + block_size]
+            visited = np.zeros((block_sources.shape[0], self.num_nodes), dtype=bool)
+            rows = np.arange(block_sources.shape[0])
+            visited[rows, block_sources] = True
+            frontier_rows, frontier_nodes = rows, block_sources
+            depth = 0
+            while frontier_rows.size > 0 and (cutoff is None or depth < cutoff):
+                depth += 1
+                counts = self.indptr[frontier_nodes + 1] - self.indptr[frontier_nodes]
+                reached_rows = np.repeat(frontier_rows, counts)
+                reached_nodes = self.neighbors[self.edge_ids_of(frontier_nodes)]
+                # de-duplicate the newly reached nodes of each row through a boolean matrix instead of sorting them
+                frontier = np.zeros_like(visited)
+                frontier[reached_rows, reached_nodes] = True
+                frontier &= ~visited
+                visited |= frontier
+                frontier_rows, frontier_nodes = np.nonzero(frontier)
+            pairs = pair_order[pair_bounds[block]:pair_bounds[block + 1]]
+            found[pairs] = visited[source_rows[pairs] - block_start, targets[pairs]]
+        return found
@@ -1,7 +1,7 @@
-import csv
-import networkx as nx
+import os
 import numpy as np
-from collections import defaultdict
+from MARS.data.cache import cache_key, save_arrays, load_arrays
+from MARS.data.ingest import ArrayVocab, read_triples
 
 
 """The data loader script which separates the indication triples into training and test datasets"""
@@ -9,29 +9,50 @@ from collections import defaultdict
 
 class RelationEntityBatcher(object):
     def __init__(self, input_dir, batch_size, entity_vocab, relation_vocab, 
-                 path_len, nx_graph, mode="train", output_dir=None):
+                 path_len, graph, mode="train", output_dir=None, cache_dir=None, graph_file=None,
+                 inverse_relations=None):
         """Creates the training or test dataset
         :param input_dir: the input directory where the data files are
         :param batch_size: the size of the sampled batch (specified by user in configs)
         :param entity_vocab: dictionary mapping the entities to their unique IDs
         :param relation_vocab: dictionary mapping the relations to their unique IDs
         :param path_len: the maximum path length to consider
-        :param nx_graph = the networkx graph object representing the whole KG
+        :param graph: the CSRGraph object representing the whole KG
         :param mode: whether it should be for the training set or the test set
         :param output_dir: the output directory where the test/val set will be written to
+        :param cache_dir: (optional) the directory in which the filtered triples and labels are cached, keyed by
+            a hash of the data files, the vocabularies, the graph and path_len
+        :param graph_file: (optional) the file of KG triples, which also holds labels for the test set;
+            by default, graph.txt in input_dir
+        :param inverse_relations: (optional) array mapping each relation ID to its inverse, if graph_file holds only
+            the forward triples and the inverse triples should be derived from them, as in the grapher
         """
         self.input_dir = input_dir
         self.output_dir = output_dir
         # get the appropriate training or test data, split beforehand
         self.input_file = input_dir+'{}.txt'.format(mode)
+        self.graph_file = graph_file or input_dir + 'graph.txt'
+        self.inverse_relations = inverse_relations
         self.batch_size = batch_size
         print('Reading vocab...')
         self.entity_vocab = entity_vocab
         self.relation_vocab = relation_vocab
+        # array-backed copies of the vocabularies, for mapping whole chunks of triples at once
+        self.entity_lookup = ArrayVocab(entity_vocab)
+        self.relation_lookup = ArrayVocab(relation_vocab)
         self.path_len = path_len
-        self.KG = nx_graph
+        self.KG = graph
         self.mode = mode
-        self.create_triple_store(self.input_file)
+        cache_file = cache_dir + f'{mode}_set_{self.cache_key()}' if cache_dir else None
+        if cache_file and os.path.exists(cache_file):
+            self.load_cache(cache_file)
+        else:
+            self.create_triple_store(self.input_file)
+            if cache_file:
+                self.save_cache(cache_file)
+        if self.no_path > 0:
+            print(f'WARNING: {self.no_path} triples in the {self.mode} set have no path (length <= {self.path_len}) through the directed edges, and were omitted.')
+        self.create_label_store()
         print(f"{self.mode} set batcher loaded.")
 
     def write_set_file(self):
@@ -40,6 +61,33 @@ class RelationEntityBatcher(object):
             raise ValueError("No output directory specified")
         np.save(self.output_dir + f'{self.mode}.npy', self.store)
 
+    def label_files(self):
+        """Gets the files from which the labels in the answer index are taken"""
+        if self.mode == 'train':
+            return [self.input_file]
+        # all files which store triples of some form
+        return [self.input_dir + f + '.txt' for f in ['train', 'dev', 'test']] + [self.graph_file]
+
+    def cache_key(self):
+        """Hashes all inputs of create_triple_store, so that its results can be re-used by later runs"""
+        return cache_key(files=[self.input_file] + self.label_files(),
+                         objects=[self.mode, self.entity_vocab, self.relation_vocab, self.path_len,
+                                  None if self.inverse_relations is None else self.inverse_relations.tolist()],
+                         arrays=[self.KG.indptr, self.KG.neighbors, self.KG.node_mask])
+
+    def save_cache(self, cache_file):
+        """Writes the filtered triples, the labels and the number of omitted triples to a cache directory"""
+        save_arrays(cache_file, {'store': self.store, 'label_triples': self.label_triples,
+                                 'no_path': np.array(self.no_path)})
+
+    def load_cache(self, cache_file):
+        """Loads the results of create_triple_store written by save_cache"""
+        arrays = load_arrays(cache_file, mmap_mode=None)
+        self.store = arrays['store']
+        self.label_triples = arrays['label_triples']
+        self.no_path = int(arrays['no_path'])
+        print(f"{self.mode} set re-loaded from {cache_file}.")
+
     def get_next_batch(self):
         """generator which yields the next batch of data"""
         if self.mode == 'train':
@@ -47,73 +95,84 @@ class RelationEntityBatcher(object):
         else:
             yield self.yield_next_batch_test()
 
+    def has_path(self, triples):
+        """Checks for each triple whether e2 is reachable from e1 in at most self.path_len hops
+        :param triples: a [num_triples, 3] array of IDs
+        :returns: a boolean array, with one entry per triple
+        """
+        in_graph = self.KG.node_mask[triples[:, 0]] & self.KG.node_mask[triples[:, 2]]
+        path = np.zeros(triples.shape[0], dtype=bool)
+        path[in_graph] = self.KG.reachable(triples[in_graph, 0], triples[in_graph, 2], cutoff=self.path_len)
+        return path
+
     def create_triple_store(self, input_file):
-        """Creates two data types: 
-            - self.store_all_correct , which contains all possible reachable sink nodes, given an entity and relation
-            - self.store , a list of all the triples (as nested lists) in the considered set
+        """Creates the data from which the batches are drawn:
+            - self.store , an array of all the triples in the considered set which have a path through the KG
+            - self.label_triples , an array of the unique triples from which the labels are taken
+            - self.no_path , the number of triples of the set which were omitted for having no path
         """
-        # store_all_correct contains, for each entity and relation, a set of sink entities reachable 
-        self.store_all_correct = defaultdict(set)
-        # store simply contains all triples in the KG
-        self.store = []
-        with open(input_file) as raw_input_file:
-            csv_file = csv.reader(raw_input_file, delimiter='\t')
-            no_path = 0
-            if self.mode == 'train':
-                for line in csv_file:
-                    # read in each triple and map it to its unique ID
-                    e1 = self.entity_vocab[line[0]]
-                    r = self.relation_vocab[line[1]]
-                    e2 = self.entity_vocab[line[2]]
-                    if e1 in self.KG and e2 in self.KG and nx.has_path(self.KG, e1, e2) and nx.shortest_path_length(self.KG, e1, e2) <= self.path_len:
-                        self.store.append([e1, r, e2])
-                        # this line is unique to the training set- we only want the labels in the training set so no leakage
-                        self.store_all_correct[(e1, r)].add(e2)
-                    else:
-                        no_path += 1
-                self.store = np.array(self.store)
-            else:
-                for line in csv_file:
-                    e1 = line[0]
-                    r = line[1]
-                    e2 = line[2]
-                    if (e1 in self.entity_vocab) and (e2 in self.entity_vocab):
-                        e1 = self.entity_vocab[e1]
-                        r = self.relation_vocab[r]
-                        e2 = self.entity_vocab[e2]
-                        if e1 in self.KG and e2 in self.KG and nx.has_path(self.KG, e1, e2) and nx.shortest_path_length(self.KG, e1, e2) <= self.path_len:
-                            self.store.append([e1, r, e2])
-                        else:
-                            no_path += 1
-                self.store = np.array(self.store)
-
-                # all files which store triples of some form
-                fact_files = ['train', 'dev', 'test', 'graph']
-                for f in fact_files:
-                    with open(self.input_dir + f + '.txt') as raw_input:
-                        csv_file = csv.reader(raw_input, delimiter='\t')
-                        for line in csv_file:
-                            e1 = line[0]
-                            r = line[1]
-                            e2 = line[2]
-                            if (e1 in self.entity_vocab) and (e2 in self.entity_vocab):
-                                e1 = self.entity_vocab[e1]
-                                r = self.relation_vocab[r]
-                                e2 = self.entity_vocab[e2]
-                                if e1 in self.KG and e2 in self.KG and nx.has_path(self.KG, e1, e2) and nx.shortest_path_length(self.KG, e1, e2) <= self.path_len:
-                                    # here, we now store ALL possible labels 
-                                    self.store_all_correct[(e1, r)].add(e2)
-
-            if no_path > 0:
-                print(f'WARNING: {no_path} triples in the {self.mode} set have no path (length <= {self.path_len}) through the directed edges, and were omitted.')
-                
+        if self.mode == 'train':
+            # read in the triples in chunks and map them to their unique IDs
+            triples = read_triples(input_file, self.entity_lookup, self.relation_lookup)
+        else:
+            triples = read_triples(input_file, self.entity_lookup, self.relation_lookup, skip_unknown_entities=True)
+        # store simply contains all triples of the set which have a path through the KG
+        path = self.has_path(triples)
+        self.store = triples[path]
+        self.no_path = int((~path).sum())
+
+        if self.mode == 'train':
+            # this is unique to the training set- we only want the labels in the training set so no leakage
+            label_triples = [self.store]
+        else:
+            label_triples = []
+            for label_file in self.label_files():
+                triples = read_triples(label_file, self.entity_lookup, self.relation_lookup,
+                                       skip_unknown_entities=True)
+                if label_file == self.graph_file and self.inverse_relations is not None:
+                    triples = np.concatenate([triples, np.stack([triples[:, 2], self.inverse_relations[triples[:, 1]],
+                                                                 triples[:, 0]], axis=1)])
+                # here, we now store ALL possible labels 
+                label_triples.append(triples[self.has_path(triples)])
+        self.label_triples = np.unique(np.concatenate(label_triples), axis=0)
+
+    def create_label_store(self):
+        """Creates the answer index, a CSR-style store of all possible reachable sink nodes, given an entity and relation:
+            - self.answer_keys , the sorted unique queries (source node and relation), as e1 * num_relations + r
+            - self.answer_indptr , the answers of query i are self.answer_ids[self.answer_indptr[i]:self.answer_indptr[i + 1]]
+            - self.answer_ids , the sink nodes of all queries, sorted within each query
+        """
+        keys = self.label_triples[:, 0] * len(self.relation_vocab) + self.label_triples[:, 1]
+        order = np.lexsort((self.label_triples[:, 2], keys))
+        self.answer_keys, starts = np.unique(keys[order], return_index=True)
+        self.answer_indptr = np.append(starts, order.shape[0]).astype(np.int64)
+        self.answer_ids = self.label_triples[order, 2].astype(np.int32)
+
+    def get_answers(self, e1, r):
+        """Looks up the answers of a batch of queries in the answer index
+        :param e1: array of the source nodes of the queries
+        :param r: array of the relations of the queries
+        :returns: a padded array (-1 as padding), in which each row holds all answers of one query
+        """
+        keys = e1.astype(np.int64) * len(self.relation_vocab) + r
+        rows = np.searchsorted(self.answer_keys, keys)
+        found = rows < self.answer_keys.shape[0]
+        found[found] = self.answer_keys[rows[found]] == keys[found]
+        rows = np.where(found, rows, 0)
+        starts = np.where(found, self.answer_indptr[rows], 0)
+        counts = np.where(found, self.answer_indptr[rows + 1] - starts, 0)
+        # the column of each answer within its row
+        cols = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        all_e2s = np.full((keys.shape[0], max(counts.max(initial=0), 1)), -1, dtype=np.int32)
+        all_e2s[np.repeat(np.arange(keys.shape[0]), counts), cols] = self.answer_ids[np.repeat(starts, counts) + cols]
+        return all_e2s
 
     def yield_next_batch_train(self):
         """Generates the next batch of training data as unique IDs:
         - e1 is a list of all triple source nodes in the batch
         - r is a list of all triple relations in the batch
         - e2 is a list of all triple sink nodes in the batch
-        - all_e2s is a list of sets, in which each set corresponds to all possible sink nodes which are reachable
+        - all_e2s is a padded array (-1 as padding), in which each row holds all possible sink nodes which are reachable
             from the source node and relation in the corresponding index of the e1 and r lists
 
         this generator has no limit and can therefore loop until training terminates
@@ -125,10 +184,8 @@ class RelationEntityBatcher(object):
             e1 = batch[:, 0]  # the 0th element of each nested list
             r = batch[:, 1]  # the 1st element of each nested list
             e2 = batch[:, 2]  # the 2nd element of each nested list
-            all_e2s = []
-            for i in range(e1.shape[0]):
-                all_e2s.append(self.store_all_correct[(e1[i], r[i])])
-            assert e1.shape[0] == e2.shape[0] == r.shape[0] == len(all_e2s)
+            all_e2s = self.get_answers(e1, r)
+            assert e1.shape[0] == e2.shape[0] == r.shape[0] == all_e2s.shape[0]
             yield e1, r, e2, all_e2s
 
     def yield_next_batch_test(self):
@@ -136,7 +193,7 @@ class RelationEntityBatcher(object):
         - e1 is a list of all triple source nodes in the batch
         - r is a list of all triple relations in the batch
         - e2 is a list of all triple sink nodes in the batch
-        - all_e2s is a list of sets, in which each set corresponds to all possible sink nodes which are reachable
+        - all_e2s is a padded array (-1 as padding), in which each row holds all possible sink nodes which are reachable
             from the source node and relation in the corresponding index of the e1 and r lists
 
         this generator stops when all test data has been used.
@@ -158,8 +215,6 @@ class RelationEntityBatcher(object):
             e1 = batch[:, 0]
             r = batch[:, 1]
             e2 = batch[:, 2]
-            all_e2s = []
-            for i in range(e1.shape[0]):
-                all_e2s.append(self.store_all_correct[(e1[i], r[i])])
-            assert e1.shape[0] == e2.shape[0] == r.shape[0] == len(all_e2s)
+            all_e2s = self.get_answers(e1, r)
+            assert e1.shape[0] == e2.shape[0] == r.shape[0] == all_e2s.shape[0]
             yield e1, r, e2, all_e2s
@@ -1,14 +1,25 @@
-import csv
+import os
 import numpy as np
 from collections import Counter, defaultdict
-import random
+import heapq
 import networkx as nx
+from MARS.data.csr_graph import CSRGraph
+from MARS.data.cache import save_arrays, load_arrays
+from MARS.data.ingest import build_csr
 
 
 """The script responsible for generating the graph structure and next steps, 
 but for each step, ensures to mask the connections representing the true answers so there is no cheating
 """
 
+def id_dtype(vocab_size):
+    """Gets the narrowest integer dtype which can hold every ID of a vocabulary of the given size"""
+    for dtype in (np.uint8, np.int16, np.int32):
+        if vocab_size - 1 <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    return np.dtype(np.int64)
+
+
 def sum_dicts(dict1, dict2):
     """Gets the sum of the values in the two dicts"""
     new_dict = dict()
@@ -23,37 +34,39 @@ def sum_dicts(dict1, dict2):
 
 class RelationEntityGrapher(object):
     def __init__(self, triple_store, entity_vocab, relation_vocab, max_branching, 
-                 graph_output_file=None, class_threshhold=None, nx_graph_obj=None, 
-                 pruned_output_file=None, pruned_graph_obj=None,
-                 np_graph_file=None, np_graph_array=None):
+                 class_threshhold=None, cache_file=None, seed=None, derive_inverses=False):
         """Initializes the creation of the graph.
             :param triple_store: the file location of the KG triples
             :param entity_vocab: the file location of the ID mappings for entities
             :param relation_vocab: the file location of the ID mappings for relations
             :param max_branching: the max number of outgoing edges from any given source node
-            :param graph_output_file: the output file to which the networkx graph should be written.
             :param class_threshhold: (optional) the max number of edges of any class to keep in the graph
-            :param nx_graph_obj: a networkx graph object to be used instead of creating a new one
-            :param np_graph_file: the output file to which the numpy array should be written
-            :param np_graph_array: a numpy array to be used instead of creating a new one
+            :param cache_file: (optional) the cache directory holding the full graph and the action tables.
+                If it exists, the graph is memory-mapped from it instead of being built; otherwise, it is written
+                after building and then memory-mapped, so that concurrent runs share one copy of it.
+            :param seed: (optional) the seed for shuffling the outgoing edges before pruning to max_branching
+            :param derive_inverses: whether triple_store holds only the forward triples, in which case the inverse
+                edges are derived from paired_relation_vocab instead of being read from the file
         """
         self.ePAD = entity_vocab['PAD']  # the ID of the PAD token for entities
         self.rPAD = relation_vocab['PAD']  # the ID of the PAD token for relations
         self.triple_store = triple_store
         self.entity_vocab = entity_vocab
         self.relation_vocab = relation_vocab
+        self.seed = seed
         # self.store is a dictionary storing all the connections from a node
         self.store = None
-        # self.array_store is a 3D array initialized with the PAD values
-        # it contains a 2D matrix for entities and relations each
-        if np_graph_array is not None:
-            self.array_store = np_graph_array
-        else:
-            self.array_store = np.ones((len(entity_vocab), max_branching, 2), dtype=np.dtype('int32'))
-            self.array_store[:, :, 0] *= self.ePAD
-            self.array_store[:, :, 1] *= self.rPAD
-            self.np_output = np_graph_file
-        self.masked_array_store = None
+        # self.G is a CSRGraph object holding the full KG
+        # self.entity_store and self.relation_store are 2D arrays initialized with the PAD values, which hold the
+        # target entity and the relation of each outgoing edge of a source node in separate contiguous tables,
+        # each with the narrowest dtype for its vocabulary
+        self.entity_store = np.full((len(entity_vocab), max_branching), self.ePAD, dtype=id_dtype(len(entity_vocab)))
+        self.relation_store = np.full((len(entity_vocab), max_branching), self.rPAD,
+                                      dtype=id_dtype(len(relation_vocab)))
+        # the forward-only view of self.G and the pruned KG, built on the first call of
+        # return_directed_graph and return_pruned_graph, respectively
+        self.directed_G = None
+        self.pruned_G = None
         self.rev_entity_vocab = dict([(v, k) for k, v in entity_vocab.items()])
         self.rev_relation_vocab = dict([(v, k) for k, v in relation_vocab.items()])
         self.paired_relation_vocab = dict()
@@ -64,35 +77,53 @@ class RelationEntityGrapher(object):
                 k_pair = f'_{k}'
             if k_pair in self.relation_vocab.keys():
                 self.paired_relation_vocab[v] = self.relation_vocab[k_pair]
-        if nx_graph_obj:
-            self.G = nx_graph_obj
-            self.pruned_G = pruned_graph_obj
-            print("KG re-loaded.")
+        # if the inverse edges are derived, this maps each forward relation to its inverse, and every other relation
+        # to -1, since the file must not hold any other relation
+        self.inverse_relations = None
+        if derive_inverses:
+            self.inverse_relations = np.full(len(relation_vocab), -1, dtype=np.int64)
+            for k, v in relation_vocab.items():
+                if '_' not in k and v in self.paired_relation_vocab:
+                    self.inverse_relations[v] = self.paired_relation_vocab[v]
+        if cache_file and os.path.exists(cache_file):
+            self.load_cache(cache_file)
+            print(f"KG re-loaded from {cache_file}.")
         else:
-            self.G = nx.MultiDiGraph()
-            self.pruned_G = nx.MultiDiGraph()
-            self.nx_output = graph_output_file
-            self.pruned_nx_output = pruned_output_file
+            self.G = None
             self.class_threshhold = class_threshhold
             self.create_graph()
             print("KG constructed.")
+            if cache_file:
+                self.save_cache(cache_file)
+                self.load_cache(cache_file)
+        # the same grapher is shared by several environments, so guard the action tables against modification
+        self.entity_store.setflags(write=False)
+        self.relation_store.setflags(write=False)
+
+    def save_cache(self, cache_file):
+        """Writes the full graph and the action tables, from which the pruned graph is derived, to a cache directory"""
+        arrays = {'entity_store': self.entity_store, 'relation_store': self.relation_store}
+        arrays.update(self.G.to_arrays('G'))
+        save_arrays(cache_file, arrays)
+
+    def load_cache(self, cache_file):
+        """Memory-maps the full graph and the action tables written by save_cache, read-only"""
+        arrays = load_arrays(cache_file)
+        self.entity_store = arrays['entity_store']
+        self.relation_store = arrays['relation_store']
+        self.G = CSRGraph.from_arrays(arrays, 'G')
+
+    def export_graphml(self, graph_output_file, pruned_output_file):
+        """Writes the full and the pruned graph to GraphML files, e.g. for inspection with other tools"""
+        nx.write_graphml(self.G.to_networkx(), graph_output_file)
+        nx.write_graphml(self.return_pruned_graph().to_networkx(), pruned_output_file)
 
     def create_graph(self):
-        """Stores all of the KG triples in a networkx graph
+        """Stores all of the KG triples in a CSR graph
         """
-        with open(self.triple_store) as triple_file_raw:
-            triple_file = csv.reader(triple_file_raw, delimiter='\t')
-            for line in triple_file:
-                # parse and map each to its unique ID
-                e1 = self.entity_vocab[line[0]]
-                r = self.relation_vocab[line[1]]
-                e2 = self.entity_vocab[line[2]]
-
-                if e1 not in self.G.nodes:
-                    self.G.add_node(e1)
-                if e2 not in self.G.nodes:
-                    self.G.add_node(e2)
-                self.G.add_edge(e1, e2, type=r)
+        # parse the file in chunks and map each triple to its unique IDs
+        self.G = build_csr(self.triple_store, self.entity_vocab, self.relation_vocab,
+                           inverse_relations=self.inverse_relations)
 
         if self.class_threshhold:
             self.reduce_graph()
@@ -100,153 +131,225 @@ class RelationEntityGrapher(object):
         # prune by the branching factor
         self.prune_graph()
 
-        # write graph to file
-        nx.write_graphml(self.G, self.nx_output)
-        nx.write_graphml(self.pruned_G, self.pruned_nx_output)
-
 
     def return_graph(self):
         return self.G
     
     def return_directed_graph(self):
-        forward_edge_types = {val for key, val in self.relation_vocab.items() if '_' not in key}
-        dir_G = self.get_subgraph(forward_edge_types)
-        return dir_G
+        if self.directed_G is None:
+            forward_edge_types = {val for key, val in self.relation_vocab.items() if '_' not in key}
+            self.directed_G = self.get_subgraph(forward_edge_types)
+        return self.directed_G
 
     def return_array_store(self):
-        return self.array_store
+        return self.entity_store, self.relation_store
 
     def get_edge_counter(self):
         """Gets a counter dictionary of the edge types in the graph"""
-        edge_types = list()
-        for edge in self.G.edges(data=True):
-            edge_type = edge[2]['type']
-            edge_types.append(edge_type)
-        edge_types = dict(Counter(edge_types))
-        return edge_types
+        return self.G.edge_counter()
     
 
     def get_subgraph(self, edge_types):
         """Given a set of edge types, returns a subgraph of the KG containing only those edge types."""
-        G_sub = nx.MultiDiGraph()
-        for edge in self.G.edges(data=True):
-            if edge[2]['type'] in edge_types:
-                if edge[0] not in G_sub.nodes:
-                    G_sub.add_node(edge[0])
-                if edge[1] not in G_sub.nodes:
-                    G_sub.add_node(edge[1])
-                G_sub.add_edge(edge[0], edge[1], type=edge[2]['type'])
-
-        return G_sub
+        return self.G.relation_subgraph(edge_types)
     
 
     def remove_isolated_nodes(self):
         # remove isolated nodes
-        isolated_nodes = list(nx.isolates(self.G))
-        self.G.remove_nodes_from(isolated_nodes)
+        self.G.remove_isolated_nodes()
+
+
+    def index_edges(self, edge_type, alive, sources):
+        """Maps every (source, target) pair to a stack of the still-alive edges of the given type between them,
+            so that the last added edge can be found and removed in constant time
+        """
+        edge_ids = self.G.relation_edge_ids(edge_type)
+        edge_ids = edge_ids[alive[edge_ids]]
+        keys = sources[edge_ids] * self.G.num_nodes + self.G.neighbors[edge_ids]
+        edge_index = defaultdict(list)
+        for key, edge_id in zip(keys.tolist(), edge_ids.tolist()):
+            edge_index[key].append(edge_id)
+        return edge_index
 
 
     def reduce_graph(self):
         """
         If class_threshhold is passed, this will reduce the graph by removing edges of any classes above the threshhold.
+        The node with the highest out-degree loses its edge to its neighbor with the highest out-degree, until the
+            class is small enough. Both choices use lazy max-heaps, in which entries hold a degree that may be outdated;
+            since degrees only ever decrease, an outdated entry is simply re-pushed with its current degree when popped.
         """
         edge_types = self.get_edge_counter()
+        sources = self.G.sources()
+        alive = np.ones(self.G.number_of_edges(), dtype=bool)
+        num_edges = self.G.number_of_edges()
         count = 0
 
         for edge_type in edge_types.keys():
-            if edge_types[edge_type] <= self.class_threshhold:
+            sub_edges = self.G.relation_edge_ids(edge_type)
+            sub_edges = sub_edges[alive[sub_edges]]
+            # paired inverse edges removed along with an earlier edge type may already have shrunk this one
+            num_sub_edges = sub_edges.shape[0]
+            if num_sub_edges <= self.class_threshhold:
                 continue
 
-            G_sub = self.get_subgraph({edge_type})
-            sub_nodes = list(G_sub)
-
             print(f'Pruning edges of type {self.rev_relation_vocab[edge_type]} to <= {self.class_threshhold} edges...')
 
-            while G_sub.number_of_edges() > self.class_threshhold:
-                
-                node_with_highest_degree = max(sub_nodes, key=lambda n: G_sub.out_degree(n))  # get the node with the most participating edges of this type
+            sub_sources = sources[sub_edges]
+            out_degree = np.bincount(sub_sources, minlength=self.G.num_nodes)
+            # edges of this type grouped by their source node
+            sub_edges = sub_edges[np.argsort(sub_sources, kind='stable')]
+            sub_indptr = np.zeros(self.G.num_nodes + 1, dtype=np.int64)
+            np.cumsum(out_degree, out=sub_indptr[1:])
+            # the max-heap of nodes by out-degree, and one max-heap per node of its edges by the out-degree of the target
+            node_heap = [(-degree, node) for node, degree in enumerate(out_degree.tolist()) if degree > 0]
+            heapq.heapify(node_heap)
+            edge_heaps = dict()
+
+            inverse_type = self.paired_relation_vocab.get(edge_type)
+            if inverse_type is not None:
+                inverse_index = self.index_edges(inverse_type, alive, sources)
+
+            while num_sub_edges > self.class_threshhold:
+
+                # get the node with the most participating edges of this type
+                neg_degree, node_with_highest_degree = heapq.heappop(node_heap)
+                if -neg_degree != out_degree[node_with_highest_degree]:
+                    continue  # outdated entry; the current degree of this node was pushed when it changed
+                if node_with_highest_degree not in edge_heaps:
+                    node_edges = sub_edges[sub_indptr[node_with_highest_degree]:sub_indptr[node_with_highest_degree + 1]]
+                    edge_heap = [(-out_degree[target], edge_id) for edge_id, target in
+                                 zip(node_edges.tolist(), self.G.neighbors[node_edges].tolist())]
+                    heapq.heapify(edge_heap)
+                    edge_heaps[node_with_highest_degree] = edge_heap
+                edge_heap = edge_heaps[node_with_highest_degree]
+
                 # Find the neighbor of node_with_highest_degree with the largest degree
-                neighbors = [node for node in nx.neighbors(G_sub, node_with_highest_degree)]
-                neighbor_of_highest_degree = max(neighbors, key=lambda n: G_sub.out_degree(n))
-                # remove the edge between prot_with_highest_degree and neighbor_of_highest_degree
-                G_sub.remove_edge(node_with_highest_degree, neighbor_of_highest_degree)
-                self.G.remove_edge(node_with_highest_degree, neighbor_of_highest_degree)
-                if edge_type in self.paired_relation_vocab:
-                    self.G.remove_edge(neighbor_of_highest_degree, node_with_highest_degree)
+                while True:
+                    neg_target_degree, edge_id = heapq.heappop(edge_heap)
+                    if not alive[edge_id]:
+                        continue
+                    neighbor_of_highest_degree = int(self.G.neighbors[edge_id])
+                    if -neg_target_degree != out_degree[neighbor_of_highest_degree]:
+                        heapq.heappush(edge_heap, (-out_degree[neighbor_of_highest_degree], edge_id))
+                        continue
+                    break
+
+                # remove the edge between node_with_highest_degree and neighbor_of_highest_degree
+                alive[edge_id] = False
+                num_sub_edges -= 1
+                num_edges -= 1
+                out_degree[node_with_highest_degree] -= 1
+                heapq.heappush(node_heap, (-out_degree[node_with_highest_degree], node_with_highest_degree))
+
+                # and remove the paired inverse edge in the same pass
+                if inverse_type is not None:
+                    inverse_edges = inverse_index.get(neighbor_of_highest_degree * self.G.num_nodes +
+                                                      node_with_highest_degree)
+                    while inverse_edges and not alive[inverse_edges[-1]]:
+                        inverse_edges.pop()
+                    if inverse_edges:
+                        alive[inverse_edges.pop()] = False
+                        num_edges -= 1
+                        if inverse_type == edge_type:
+                            num_sub_edges -= 1
+                            out_degree[neighbor_of_highest_degree] -= 1
+                            heapq.heappush(node_heap, (-out_degree[neighbor_of_highest_degree],
+                                                       neighbor_of_highest_degree))
                 count += 1
                 if count % 1000 == 0:
-                    print(f'Number of edges left in graph: {self.G.number_of_edges()}')
+                    print(f'Number of edges left in graph: {num_edges}')
 
             print(f'Finished with edge type: {self.rev_relation_vocab[edge_type]}.')
 
+        self.G = self.G.edge_subgraph(alive)
         self.remove_isolated_nodes()
 
 
     def prune_graph(self):
-        """Prunes the graph to the specified branching factor"""
-        pruned_G = nx.MultiDiGraph()
-        source_nodes = [node for node in self.G.nodes() if self.G.out_degree(node) > 0]
-        for source_node in source_nodes :  # for every source node / dict key
-            pruned_G.add_node(source_node)
-            # first, give the agent the option to remain at every source node:
-            self.array_store[source_node, 0, 1] = self.relation_vocab['NO_OP']  # no operation / no movement
-            self.array_store[source_node, 0, 0] = source_node  # self-connection / stay where you are
-            num_actions = 1
-
-            # shuffle the keys so the order is not determined by the input file
-            target_nodes = list(nx.neighbors(self.G, source_node))
-            random.shuffle(target_nodes)
-
-            for target_node in target_nodes:  # for each connecting node,
-                # if we reached the max number of actions, stop
-                if num_actions == self.array_store.shape[1]:
-                    break
-                pruned_G.add_node(target_node)
-                # store the number of the current outgoing edge as an index
-                self.array_store[source_node, num_actions, 0] = target_node
-                edge_type = self.G.get_edge_data(source_node, target_node)[0]['type']
-                self.array_store[source_node, num_actions, 1] = edge_type
-                pruned_G.add_edge(source_node, target_node, type=edge_type)
-                num_actions += 1
-
-        np.save(self.np_output, self.array_store)
-        self.pruned_G = pruned_G
+        """Prunes the graph to the specified branching factor.
+        Every (source, target) pair is kept once, with the type of its first edge. The pairs of each source node
+            are shuffled by one seeded permutation, so the order is not determined by the input file, and only the
+            first max_branching - 1 of them are written into the action tables, after the self-connection.
+        """
+        rng = np.random.default_rng(self.seed)
+        num_nodes = self.G.num_nodes
+        # every unique (source, target) pair, and the first edge leading from the source to the target
+        pair_keys, first_edges = np.unique(self.G.sources() * num_nodes + self.G.neighbors, return_index=True)
+        pair_sources = pair_keys // num_nodes
+        # shuffle the pairs, then group them by source node again; lexsort sorts by its last key first
+        order = np.lexsort((rng.permutation(pair_keys.shape[0]), pair_sources))
+        pair_sources = pair_sources[order]
+        pair_targets = (pair_keys % num_nodes)[order]
+        pair_relations = self.G.relations[first_edges[order]]
+        # the position of each pair among the pairs of its source node
+        source_nodes, group_starts, group_sizes = np.unique(pair_sources, return_index=True, return_counts=True)
+        ranks = np.arange(pair_sources.shape[0]) - np.repeat(group_starts, group_sizes)
+        # if we reached the max number of actions, stop
+        kept = ranks < self.entity_store.shape[1] - 1
+
+        # first, give the agent the option to remain at every source node:
+        self.entity_store[source_nodes, 0] = source_nodes  # self-connection / stay where you are
+        self.relation_store[source_nodes, 0] = self.relation_vocab['NO_OP']  # no operation / no movement
+        # then store the outgoing edges after the self-connection
+        self.entity_store[pair_sources[kept], ranks[kept] + 1] = pair_targets[kept]
+        self.relation_store[pair_sources[kept], ranks[kept] + 1] = pair_relations[kept]
+
+    def return_pruned_graph(self):
+        """Returns the pruned KG, i.e. the edges which made it into the action tables, built on the first call"""
+        if self.pruned_G is None:
+            relations = self.relation_store[:, 1:]
+            kept = relations != self.rPAD
+            sources = np.nonzero(kept)[0]
+            self.pruned_G = CSRGraph.from_edges(sources, relations[kept], self.entity_store[:, 1:][kept],
+                                                self.G.num_nodes)
+        return self.pruned_G
 
 
     def return_next_actions(self, current_entities, start_entities, query_relations, end_entities, all_correct_answers,
                             is_last_step, rollouts):
-        """Using the matrices in self.array_store, return the actions that could be taken
+        """Using the matrices in self.entity_store and self.relation_store, return the actions that could be taken
             by the agent from a given node. Mask the source nodes from the true labels in the dataset.
+        Rollouts of the same query which sit on the same entity get the same actions, so the actions are only
+            computed once for every unique (query, current entity) pair, and mapped back to the rows through an index.
         :param current_entities: a list of the entities which the agent is currently considering
         :param start_entities: an array containing all the source nodes within the data batch triples
         :param query_relations: an array containing all relations within the data batch triples
         :param end_entities: an array containing all the target nodes within the data batch triples
-        :param all_correct_answers: a mapping from sink nodes (keys) to tuples of source nodes and relations from which they are reachable
+        :param all_correct_answers: a padded array (-1 as padding) holding, for each query in the batch,
+            all sink nodes which are reachable from its source node and relation
         :param is_last_step: boolean indicating whether it's the max path length
+        :param rollouts: the number of consecutive rows which belong to the same query
 
-        :returns: a copy of self.array_store in which (1) only the next possible actions are shown, and (2) the
-            true labels from the dataset are masked so that the model can not cheat
+        :returns: 3 arrays:
+            - copies of the rows of self.entity_store and self.relation_store for the unique (query, current entity)
+                pairs, in which (1) only the next possible actions are shown, and (2) the true labels from the dataset
+                are masked so that the model can not cheat
+            - the index of the unique pair of each row, so that entities[row_index] holds the actions of every row
         """
+        num_entities = self.entity_store.shape[0]
+        row_query_idx = np.arange(current_entities.shape[0], dtype=np.int64) // rollouts
+        _, unique_rows, row_index = np.unique(row_query_idx * num_entities + current_entities,
+                                              return_index=True, return_inverse=True)
+        current_entities = current_entities[unique_rows]
+        query_idx = row_query_idx[unique_rows][:, np.newaxis]
+        start_entities = start_entities[unique_rows]
+        query_relations = query_relations[unique_rows][:, np.newaxis]
+        end_entities = end_entities[unique_rows][:, np.newaxis]
         # get only the connections from the entities currently being considered
-        ret = self.array_store[current_entities, :, :].copy()
-        for i in range(current_entities.shape[0]):
-            # if we still have any beginning nodes:
-            if current_entities[i] == start_entities[i]:
-                # get the entities and relations which are accessible from that entity in the KG
-                entities = ret[i, :, 0]  # vector of target nodes connected to i
-                relations = ret[i, :, 1]  # vector of relations connected to i
-                # identify the connections in the batch and mask them 
-                # mask is a vector of boolean indications, where if True, the mask 
-                mask = np.logical_and(relations == query_relations[i], entities == end_entities[i])
-                ret[i, :, 0][mask] = self.ePAD
-                ret[i, :, 1][mask] = self.rPAD
-            if is_last_step:
-                entities = ret[i, :, 0]  # vector of target nodes connected to source node at i
-                correct_e2 = end_entities[i]  # the sink node in triple index i
-                # for each of the sink nodes connected to source nodes i,
-                for j in range(entities.shape[0]):
-                    # here we hide correct answers which are not in the current set - no cheating
-                    if entities[j] in all_correct_answers[i // rollouts] and entities[j] != correct_e2:
-                        ret[i, :, 0][j] = self.ePAD
-                        ret[i, :, 1][j] = self.rPAD
-        return ret
+        # (fancy indexing already returns contiguous copies)
+        entities = self.entity_store[current_entities]  # matrix of target nodes connected to each current entity
+        relations = self.relation_store[current_entities]  # matrix of relations connected to each current entity
+        # for the rows still at their beginning node, mask the query triple itself
+        at_start = (current_entities == start_entities)[:, np.newaxis]
+        mask = at_start & (relations == query_relations) & (entities == end_entities)
+        if is_last_step:
+            # here we hide correct answers which are not the current sink node - no cheating
+            # every (query, entity) pair is encoded as one integer, so membership is a single np.isin call
+            answer_idx = np.arange(all_correct_answers.shape[0], dtype=np.int64)[:, np.newaxis]
+            answer_keys = (answer_idx * num_entities + all_correct_answers)[all_correct_answers >= 0]
+            is_answer = np.isin(query_idx * num_entities + entities, answer_keys)
+            mask |= is_answer & (entities != end_entities)
+        entities[mask] = self.ePAD
+        relations[mask] = self.rPAD
+        return entities, relations, row_index.reshape(-1)
@@ -0,0 +1,139 @@
+import os
+import tempfile
+from itertools import islice
+import numpy as np
+from MARS.data.csr_graph import CSRGraph
+
+
+"""Chunked reading of tab-separated triple files with a bounded memory footprint. The names are mapped to their IDs
+in bulk, and for building the KG, the ID triples are spilled to disk as runs sorted by source node, which are then
+merged into the CSR arrays
+"""
+
+CHUNK_SIZE = 1000000  # the number of lines which are read and mapped at once
+
+
+class ArrayVocab(object):
+    """A vocabulary backed by a sorted array of (byte string) names instead of a Python dict"""
+    def __init__(self, vocab):
+        """:param vocab: dictionary mapping the names to their unique IDs"""
+        names = np.array([name.encode() for name in vocab.keys()], dtype=bytes)
+        ids = np.fromiter(vocab.values(), dtype=np.int64, count=len(vocab))
+        order = np.argsort(names)
+        self.names = names[order]
+        self.ids = ids[order]
+
+    def lookup(self, names):
+        """Maps an array of byte string names to their IDs, with -1 for names which are not in the vocabulary"""
+        if self.names.shape[0] == 0:
+            return np.full(len(names), -1, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self.names, names), self.names.shape[0] - 1)
+        found = self.names[positions] == names
+        return np.where(found, self.ids[positions], -1)
+
+
+def read_triple_chunks(input_file, chunk_size=CHUNK_SIZE):
+    """Generator which reads a tab-separated triple file in blocks of lines
+    :param input_file: the file location of the triples
+    :param chunk_size: the number of lines in each block
+
+    :returns: for each block, a [num_lines, 3] array of byte strings
+    """
+    with open(input_file, 'rb') as raw_input_file:
+        while True:
+            lines = list(islice(raw_input_file, chunk_size))
+            if not lines:
+                return
+            fields = b'\t'.join(line.rstrip(b'\r\n') for line in lines if line.strip()).split(b'\t')
+            if len(fields) % 3 != 0:
+                raise ValueError(f'{input_file} contains lines which are not tab-separated triples.')
+            yield np.array(fields, dtype=bytes).reshape(-1, 3)
+
+
+def map_triples(chunk, entity_lookup, relation_lookup, skip_unknown_entities=False):
+    """Maps a block of triples from names to IDs
+    :param chunk: a [num_lines, 3] array of byte string names, as yielded by read_triple_chunks
+    :param entity_lookup: the ArrayVocab of the entities
+    :param relation_lookup: the ArrayVocab of the relations
+    :param skip_unknown_entities: whether triples with entities outside the vocabulary are dropped instead of raising
+
+    :returns: a [num_triples, 3] array of IDs
+    """
+    triples = np.stack([entity_lookup.lookup(chunk[:, 0]), relation_lookup.lookup(chunk[:, 1]),
+                        entity_lookup.lookup(chunk[:, 2])], axis=1)
+    known_entities = (triples[:, 0] >= 0) & (triples[:, 2] >= 0)
+    if skip_unknown_entities:
+        triples, chunk = triples[known_entities], chunk[known_entities]
+    if not known_entities.all() and not skip_unknown_entities or (triples[:, 1] < 0).any():
+        unknown = np.nonzero((triples < 0).any(axis=1))[0][0]
+        raise KeyError('Triple with names outside of the vocabulary: ' +
+                       ' '.join(name.decode() for name in chunk[unknown]))
+    return triples
+
+
+def read_triples(input_file, entity_lookup, relation_lookup, skip_unknown_entities=False, chunk_size=CHUNK_SIZE):
+    """Reads a whole triple file into a [num_triples, 3] array of IDs, see map_triples"""
+    triples = [map_triples(chunk, entity_lookup, relation_lookup, skip_unknown_entities)
+               for chunk in read_triple_chunks(input_file, chunk_size)]
+    if not triples:
+        return np.zeros((0, 3), dtype=np.int64)
+    return np.concatenate(triples)
+
+
+def build_csr(input_file, entity_vocab, relation_vocab, chunk_size=CHUNK_SIZE, spill_dir=None, inverse_relations=None):
+    """Builds a CSRGraph from a triple file without holding more than one block of the file in memory.
+    Each block is mapped to IDs, sorted by source node and spilled to disk. The sorted runs are then merged
+        by placing every edge at its final position, which keeps the edges of each source node in file order.
+    :param input_file: the file location of the KG triples
+    :param entity_vocab: dictionary mapping the entities to their unique IDs
+    :param relation_vocab: dictionary mapping the relations to their unique IDs
+    :param chunk_size: the number of lines in each block
+    :param spill_dir: (optional) the directory in which the sorted runs are temporarily stored
+    :param inverse_relations: (optional) array mapping each relation ID to the ID of its inverse relation, or to -1.
+        If given, the file holds the forward triples only, and the inverse of each triple is added as well.
+        The inverse edges come after all forward edges of their source node, as if the file of inverse triples
+        had been appended to the file of forward triples.
+    """
+    num_nodes = len(entity_vocab)
+    entity_lookup = ArrayVocab(entity_vocab)
+    relation_lookup = ArrayVocab(relation_vocab)
+    counts = np.zeros(num_nodes, dtype=np.int64)
+    with tempfile.TemporaryDirectory(dir=spill_dir) as tmp_dir:
+        run_files, inverse_run_files = [], []
+
+        def spill(triples, runs):
+            """Sorts a block of ID triples by source node and writes it as a run"""
+            nonlocal counts
+            triples = triples[np.argsort(triples[:, 0], kind='stable')]
+            run_file = os.path.join(tmp_dir, f'run_{len(run_files) + len(inverse_run_files)}.npy')
+            np.save(run_file, triples.T.astype(np.int32))
+            runs.append(run_file)
+            counts += np.bincount(triples[:, 0], minlength=num_nodes)
+
+        for chunk in read_triple_chunks(input_file, chunk_size):
+            triples = map_triples(chunk, entity_lookup, relation_lookup)
+            spill(triples, run_files)
+            if inverse_relations is not None:
+                inverses = inverse_relations[triples[:, 1]]
+                if (inverses < 0).any():
+                    unknown = np.nonzero(inverses < 0)[0][0]
+                    raise ValueError(f'{input_file} should only hold forward triples, but contains a relation '
+                                     f'without an inverse: ' + ' '.join(name.decode() for name in chunk[unknown]))
+                spill(np.stack([triples[:, 2], inverses, triples[:, 0]], axis=1), inverse_run_files)
+
+        indptr = np.zeros(num_nodes + 1, dtype=np.int64)
+        np.cumsum(counts, out=indptr[1:])
+        neighbors = np.empty(indptr[-1], dtype=np.int32)
+        relations = np.empty(indptr[-1], dtype=np.int32)
+        # the next free position in the edges of each source node
+        next_position = indptr[:-1].copy()
+        for run_file in run_files + inverse_run_files:
+            sources, run_relations, targets = np.load(run_file)
+            run_counts = np.bincount(sources, minlength=num_nodes)
+            # the rank of each edge among the edges of its source node within this run
+            ranks = np.arange(sources.shape[0]) - (np.cumsum(run_counts) - run_counts)[sources]
+            positions = next_position[sources] + ranks
+            neighbors[positions] = targets
+            relations[positions] = run_relations
+            next_position += run_counts
+    return CSRGraph(indptr, neighbors, relations)
@@ -1,4 +1,3 @@
-import numpy as np
 import tensorflow as tf
 
 
@@ -15,14 +14,18 @@ class Agent(object):
         self.LSTM_Layers = params['LSTM_layers']
         self.num_rollouts = params['num_rollouts']
         self.test_rollouts = params['test_rollouts']
-        self.batch_size = params['batch_size'] * params['num_rollouts']  # since we repeat w num_rollouts
-        self.dummy_start_labels = tf.constant(
-            np.ones(self.batch_size, dtype='int64') * params['relation_vocab']['DUMMY_START_RELATION'])
+        self.dummy_start_relation = params['relation_vocab']['DUMMY_START_RELATION']
         # Below: Either 0 or 1. Flag to check whether the entity embeddings should be trained after initialization.
         self.train_entities = params['train_entity_embeddings']
         self.train_relations = params['train_relation_embeddings']
         # int. Either 0 or 1. Flag to check whether the paths should use the entity embeddings.
         self.use_entity_embeddings = params['use_entity_embeddings']
+        # Either 0 or 1. Flag to check whether the relation half of the action scores is computed against the whole
+        # relation table instead of from an embedding gathered for every candidate action
+        self.factorized_scoring = params['factorized_scoring']
+        # Either 0 or 1. Flag to check whether the policy runs once per unique input row during training, instead of
+        # once per rollout
+        self.dedup_rollouts = params['dedup_rollouts']
         # TODO: what does this mean?
         if self.use_entity_embeddings:
             self.m = 4
@@ -73,8 +76,44 @@ class Agent(object):
                 action_embedding = relation_embedding
         return action_embedding
 
-    def step(self, next_relations, next_entities, current_entities, prev_states, prev_relations, query_embeddings,
-             range_arr):
+    def score_actions(self, output, next_relations, next_entities):
+        """Scores every candidate action by the dot product of its embedding with the output of the policy MLP
+        :returns: the scores, [rows, max_branching]
+        """
+        if not self.factorized_scoring:
+            candidate_action_embeddings = self.action_encoder(next_relations, next_entities)
+            output_expanded = tf.expand_dims(output, axis=1)
+            return tf.reduce_sum(input_tensor=tf.multiply(candidate_action_embeddings, output_expanded), axis=2)
+
+        # the dot product splits into a relation half and an entity half; the relation vocab is small, so the
+        # relation half is computed once for every relation, [rows, action_vocab_size], and looked up by ID
+        relation_output = output[:, :2 * self.embedding_size]
+        relation_scores = tf.matmul(relation_output, self.relation_lookup_table, transpose_b=True)
+        scores = tf.gather(relation_scores, next_relations, batch_dims=1)
+        if self.use_entity_embeddings:
+            # the entity vocab is large, so only the embeddings of the candidate entities are gathered
+            entity_output = tf.expand_dims(output[:, 2 * self.embedding_size:], axis=1)
+            entity_embedding = tf.compat.v1.nn.embedding_lookup(params=self.entity_lookup_table, ids=next_entities)
+            scores += tf.reduce_sum(input_tensor=tf.multiply(entity_embedding, entity_output), axis=2)
+        return scores
+
+    def unique_rows(self, query_idx, prev_relations, current_entities):
+        """Groups the rows of a hop whose policy inputs are identical. The candidate actions of a row are determined
+        by its query and its current entity, so rows which share the query, the previous relation and the current
+        entity get the same scores, as long as they also share the LSTM state.
+        :returns: the index of one representative row for each group, and the group of each row
+        """
+        keys = (tf.cast(query_idx, tf.int64) * self.action_vocab_size + tf.cast(prev_relations, tf.int64)) * \
+            self.entity_vocab_size + tf.cast(current_entities, tf.int64)
+        _, row_groups = tf.unique(keys)
+        representatives = tf.math.unsorted_segment_min(tf.range(tf.shape(input=keys)[0]), row_groups,
+                                                       tf.reduce_max(input_tensor=row_groups) + 1)
+        return representatives, row_groups
+
+    def policy(self, next_relations, next_entities, current_entities, prev_states, prev_relations, query_embeddings):
+        """Runs the LSTM and the policy MLP, and scores the candidate actions
+        :returns: the scores, with -99999 for the PAD actions, and the new LSTM states
+        """
         prev_action_embeddings = self.action_encoder(prev_relations, current_entities)
 
         # One step of RNN
@@ -87,27 +126,48 @@ class Agent(object):
         else:
             states = output
         state_query_concat = tf.concat([states, query_embeddings], axis=-1)
-        candidate_action_embeddings = self.action_encoder(next_relations, next_entities)
 
         # MLP for policy
         output = self.policy_MLP(state_query_concat)
-        output_expanded = tf.expand_dims(output, axis=1)
-        prelim_scores = tf.reduce_sum(input_tensor=tf.multiply(candidate_action_embeddings, output_expanded), axis=2)
+        prelim_scores = self.score_actions(output, next_relations, next_entities)
 
         # Masking PAD actions
         comparison_tensor = tf.ones_like(next_relations, dtype=tf.int32) * self.rPAD
         mask = tf.equal(next_relations, comparison_tensor)
         dummy_scores = tf.ones_like(prelim_scores) * -99999.0
         scores = tf.compat.v1.where(mask, dummy_scores, prelim_scores)
+        return scores, new_states
 
-        # Sample action
+    def step(self, next_relations, next_entities, current_entities, prev_states, prev_relations, query_embeddings,
+             range_arr, query_idx=None):
+        """Takes one hop for every row
+        :param query_idx: (optional) the index of the query of each row; if given, the policy is only run for one
+            representative of the rows with identical inputs, and its scores are shared with the others. The actions
+            are still sampled for every row, so the gradients of every row's loss flow back to its representative.
+            This needs the rows of a group to share their LSTM state, as do the rows of __call__ and rollout, where
+            every hop starts from the zero state.
+        """
+        if query_idx is None:
+            scores, new_states = self.policy(next_relations, next_entities, current_entities, prev_states,
+                                             prev_relations, query_embeddings)
+        else:
+            representatives, row_groups = self.unique_rows(query_idx, prev_relations, current_entities)
+            group_scores, group_new_states = self.policy(
+                tf.gather(next_relations, representatives), tf.gather(next_entities, representatives),
+                tf.gather(current_entities, representatives),
+                tf.nest.map_structure(lambda state: tf.gather(state, representatives), prev_states),
+                tf.gather(prev_relations, representatives), tf.gather(query_embeddings, representatives))
+            # each row gets the scores of its group
+            scores = tf.gather(group_scores, row_groups)
+            new_states = tf.nest.map_structure(lambda state: tf.gather(state, row_groups), group_new_states)
+
+        # Sample action; feeding actions_idx replaces the sampled actions, e.g. to replay a rollout
         actions = tf.cast(tf.random.categorical(logits=scores, num_samples=1), dtype=tf.int32)
+        actions_idx = tf.compat.v1.placeholder_with_default(tf.squeeze(actions, axis=1), shape=[None])
 
         # Loss
-        labels_actions = tf.squeeze(actions, axis=1)
-        loss = tf.nn.sparse_softmax_cross_entropy_with_logits(logits=scores, labels=labels_actions)
+        loss = tf.nn.sparse_softmax_cross_entropy_with_logits(logits=scores, labels=actions_idx)
 
-        actions_idx = tf.squeeze(actions)
         chosen_relations = tf.gather_nd(next_relations, tf.transpose(a=tf.stack([range_arr, actions_idx])))
 
         return loss, tf.nn.log_softmax(scores), new_states, actions_idx, chosen_relations
@@ -118,8 +178,12 @@ class Agent(object):
             the corresponding actions sequences
         """
         query_embeddings = tf.compat.v1.nn.embedding_lookup(params=self.relation_lookup_table, ids=query_relations)
-        states = self.policy_step.zero_state(batch_size=self.batch_size, dtype=tf.float32)
-        prev_relations = self.dummy_start_labels
+        # the number of rows is only known when the graph is run, so that it can also run on parts of a batch
+        batch_size = tf.shape(input=query_relations)[0]
+        states = self.policy_step.zero_state(batch_size=batch_size, dtype=tf.float32)
+        prev_relations = tf.fill([batch_size], self.dummy_start_relation)
+        # the rollouts of a query are consecutive rows
+        query_idx = range_arr // self.num_rollouts if self.dedup_rollouts else None
         all_loss = []
         all_logits = []
         actions_idx = []
@@ -135,10 +199,51 @@ class Agent(object):
                 # for each hop in the path length, the agent should take a step
                 loss, logits, new_states, idx, chosen_relations = self.step(
                     next_possible_relations, next_possible_entities, current_entities_t, states, prev_relations,
-                    query_embeddings, range_arr)
+                    query_embeddings, range_arr, query_idx)
                 all_loss.append(loss)
                 all_logits.append(logits)
                 actions_idx.append(idx)
                 prev_relations = chosen_relations
 
         return all_loss, all_logits, actions_idx
+
+    def rollout(self, environment, query_relations, range_arr, path_length):
+        """Like __call__, but the candidate actions of each hop are looked up and masked by an InGraphEnvironment,
+            from the actions sampled in the previous hop, so that a whole rollout is computed in one session call
+        :returns: the loss, logits and actions sequences of __call__, and the sequences of the chosen relations
+            and entities
+        """
+        query_embeddings = tf.compat.v1.nn.embedding_lookup(params=self.relation_lookup_table, ids=query_relations)
+        batch_size = tf.shape(input=query_relations)[0]
+        states = self.policy_step.zero_state(batch_size=batch_size, dtype=tf.float32)
+        prev_relations = tf.fill([batch_size], self.dummy_start_relation)
+        # the rollouts of a query are consecutive rows
+        query_idx = range_arr // self.num_rollouts if self.dedup_rollouts else None
+        current_entities_t = environment.start_entities
+        all_loss = []
+        all_logits = []
+        actions_idx = []
+        chosen_relations_sequence = []
+        chosen_entities_sequence = []
+
+        with tf.compat.v1.variable_scope('policy_steps_unroll') as scope:
+            for t in range(path_length):
+                if t > 0:
+                    scope.reuse_variables()
+                next_possible_entities, next_possible_relations = environment.next_actions(
+                    current_entities_t, query_relations, t == path_length - 1)
+
+                # for each hop in the path length, the agent should take a step
+                loss, logits, new_states, idx, chosen_relations = self.step(
+                    next_possible_relations, next_possible_entities, current_entities_t, states, prev_relations,
+                    query_embeddings, range_arr, query_idx)
+                all_loss.append(loss)
+                all_logits.append(logits)
+                actions_idx.append(idx)
+                prev_relations = chosen_relations
+                # the environment moves each row to the entity of its chosen action
+                current_entities_t = tf.gather_nd(next_possible_entities, tf.stack([range_arr, idx], axis=1))
+                chosen_relations_sequence.append(chosen_relations)
+                chosen_entities_sequence.append(current_entities_t)
+
+        return all_loss, all_logits, actions_idx, chosen_relations_sequence, chosen_entities_sequence
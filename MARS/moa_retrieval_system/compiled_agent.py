@@ -0,0 +1,259 @@
+import os
+import sys
+import json
+import time
+import logging
+import numpy as np
+import tensorflow as tf
+
+
+"""A TF2 version of the policy in agent.py, whose step and unrolled call are compiled with XLA through
+tf.function(jit_compile=True) instead of being run through a TF1 session. Its variables carry the names of the
+TF1 graph, so models trained with the partial_run loop can be loaded with load_tf1_checkpoint.
+Run as a script with the usual options, it benchmarks both against each other on the train set.
+"""
+
+logger = logging.getLogger(__name__)
+
+
+class CompiledAgent(tf.Module):
+    def __init__(self, params):
+        super(CompiledAgent, self).__init__(name='compiled_agent')
+        self.action_vocab_size = len(params['relation_vocab'])
+        self.entity_vocab_size = len(params['entity_vocab'])
+        self.rPAD = params['relation_vocab']['PAD']
+        self.dummy_start_relation = params['relation_vocab']['DUMMY_START_RELATION']
+        self.embedding_size = params['embedding_size']
+        self.hidden_size = params['hidden_size']
+        self.LSTM_Layers = params['LSTM_layers']
+        self.use_entity_embeddings = params['use_entity_embeddings']
+        self.factorized_scoring = params['factorized_scoring']
+        self.m = 4 if self.use_entity_embeddings else 2
+        glorot = tf.keras.initializers.GlorotUniform()
+        # maps the name of each variable in the TF1 graph to its counterpart here
+        self.tf1_variables = dict()
+
+        def variable(tf1_name, shape, initializer=glorot, trainable=True):
+            self.tf1_variables[tf1_name] = tf.Variable(initializer(shape), trainable=trainable,
+                                                       name=tf1_name.replace('/', '.'))
+            return self.tf1_variables[tf1_name]
+
+        self.relation_lookup_table = variable('action_lookup_table/relation_lookup_table',
+                                              [self.action_vocab_size, 2 * self.embedding_size],
+                                              trainable=params['train_relation_embeddings'])
+        self.entity_lookup_table = variable('entity_lookup_table/entity_lookup_table',
+                                            [self.entity_vocab_size, 2 * self.embedding_size],
+                                            initializer=glorot if self.use_entity_embeddings else tf.zeros,
+                                            trainable=params['train_entity_embeddings'])
+
+        # the LSTM cells with peepholes of tf.compat.v1.nn.rnn_cell.LSTMCell, which Keras LSTM layers do not have
+        units = self.m * self.hidden_size
+        input_size = self.m * self.embedding_size if self.use_entity_embeddings else 2 * self.embedding_size
+        self.lstm_cells = []
+        for layer in range(self.LSTM_Layers):
+            scope = f'policy_steps_unroll/multi_rnn_cell/cell_{layer}/lstm_cell/'
+            self.lstm_cells.append({'kernel': variable(scope + 'kernel', [input_size + units, 4 * units]),
+                                    'bias': variable(scope + 'bias', [4 * units], initializer=tf.zeros),
+                                    'w_f_diag': variable(scope + 'w_f_diag', [units]),
+                                    'w_i_diag': variable(scope + 'w_i_diag', [units]),
+                                    'w_o_diag': variable(scope + 'w_o_diag', [units])})
+            input_size = units
+
+        state_size = units + 2 * self.embedding_size if self.use_entity_embeddings else units
+        mlp_sizes = [state_size + 2 * self.embedding_size, 4 * self.hidden_size, self.m * self.embedding_size]
+        self.mlp_layers = []
+        for layer, name in enumerate(['dense', 'dense_1']):
+            scope = f'policy_steps_unroll/MLP_for_policy/{name}/'
+            self.mlp_layers.append({'kernel': variable(scope + 'kernel', mlp_sizes[layer:layer + 2]),
+                                    'bias': variable(scope + 'bias', [mlp_sizes[layer + 1]], initializer=tf.zeros)})
+
+    def load_tf1_checkpoint(self, checkpoint_path):
+        """Loads the variables of a model saved by the TF1 trainer, e.g. '.../moa_retrieval_system/model.ckpt'"""
+        reader = tf.train.load_checkpoint(checkpoint_path)
+        for tf1_name, var in self.tf1_variables.items():
+            var.assign(reader.get_tensor(tf1_name))
+
+    def zero_state(self, batch_size):
+        return [(tf.zeros([batch_size, self.m * self.hidden_size]), tf.zeros([batch_size, self.m * self.hidden_size]))
+                for _ in range(self.LSTM_Layers)]
+
+    def lstm(self, inputs, prev_states):
+        """One step of the stacked LSTM, with the gates and the forget bias of tf.compat.v1.nn.rnn_cell.LSTMCell"""
+        new_states = []
+        for cell, (c_prev, m_prev) in zip(self.lstm_cells, prev_states):
+            lstm_matrix = tf.matmul(tf.concat([inputs, m_prev], axis=1), cell['kernel']) + cell['bias']
+            i, j, f, o = tf.split(lstm_matrix, 4, axis=1)
+            c = tf.sigmoid(f + 1.0 + cell['w_f_diag'] * c_prev) * c_prev + \
+                tf.sigmoid(i + cell['w_i_diag'] * c_prev) * tf.tanh(j)
+            inputs = tf.sigmoid(o + cell['w_o_diag'] * c) * tf.tanh(c)
+            new_states.append((c, inputs))
+        return inputs, new_states
+
+    def policy_MLP(self, state):
+        for layer in self.mlp_layers:
+            state = tf.nn.relu(tf.matmul(state, layer['kernel']) + layer['bias'])
+        return state
+
+    def action_encoder(self, next_relations, next_entities):
+        relation_embedding = tf.gather(self.relation_lookup_table, next_relations)
+        if self.use_entity_embeddings:
+            return tf.concat([relation_embedding, tf.gather(self.entity_lookup_table, next_entities)], axis=-1)
+        return relation_embedding
+
+    def score_actions(self, output, next_relations, next_entities):
+        """Same as Agent.score_actions"""
+        if not self.factorized_scoring:
+            return tf.reduce_sum(self.action_encoder(next_relations, next_entities) * tf.expand_dims(output, axis=1),
+                                 axis=2)
+        relation_scores = tf.matmul(output[:, :2 * self.embedding_size], self.relation_lookup_table, transpose_b=True)
+        scores = tf.gather(relation_scores, next_relations, batch_dims=1)
+        if self.use_entity_embeddings:
+            scores += tf.reduce_sum(tf.gather(self.entity_lookup_table, next_entities) *
+                                    tf.expand_dims(output[:, 2 * self.embedding_size:], axis=1), axis=2)
+        return scores
+
+    def policy_step(self, next_relations, next_entities, current_entities, prev_states, prev_relations,
+                    query_embeddings):
+        """Same as Agent.step: scores the candidate actions, samples one action per row, and returns
+            the loss, the log-probabilities, the new LSTM states, the chosen action indices and relations
+        """
+        # the action tables of the grapher use the narrowest dtype for their vocabulary
+        next_relations, next_entities, current_entities, prev_relations = [
+            tf.cast(ids, tf.int32) for ids in (next_relations, next_entities, current_entities, prev_relations)]
+        output, new_states = self.lstm(self.action_encoder(prev_relations, current_entities), prev_states)
+        if self.use_entity_embeddings:
+            states = tf.concat([output, tf.gather(self.entity_lookup_table, current_entities)], axis=-1)
+        else:
+            states = output
+        output = self.policy_MLP(tf.concat([states, query_embeddings], axis=-1))
+        prelim_scores = self.score_actions(output, next_relations, next_entities)
+
+        # Masking PAD actions
+        scores = tf.where(tf.equal(next_relations, self.rPAD), tf.ones_like(prelim_scores) * -99999.0, prelim_scores)
+
+        # Sample action
+        actions_idx = tf.cast(tf.random.categorical(logits=scores, num_samples=1), dtype=tf.int32)[:, 0]
+        loss = tf.nn.sparse_softmax_cross_entropy_with_logits(logits=scores, labels=actions_idx)
+        chosen_relations = tf.gather(next_relations, actions_idx, batch_dims=1)
+        return loss, tf.nn.log_softmax(scores), new_states, actions_idx, chosen_relations
+
+    @tf.function(jit_compile=True)
+    def step(self, next_relations, next_entities, current_entities, prev_states, prev_relations, query_embeddings):
+        """The compiled policy_step"""
+        return self.policy_step(next_relations, next_entities, current_entities, prev_states, prev_relations,
+                                query_embeddings)
+
+    @tf.function(jit_compile=True)
+    def __call__(self, candidate_relation_sequence, candidate_entity_sequence, current_entities, query_relations):
+        """Same as Agent.__call__: takes a step for each hop of the given candidate sequences, and returns
+            the losses, logits and action indices of all hops
+        """
+        query_embeddings = tf.gather(self.relation_lookup_table, query_relations)
+        states = self.zero_state(tf.shape(query_relations)[0])
+        prev_relations = tf.fill(tf.shape(query_relations), self.dummy_start_relation)
+        all_loss, all_logits, actions_idx = [], [], []
+        for t in range(len(candidate_relation_sequence)):
+            loss, logits, _, idx, prev_relations = self.policy_step(
+                candidate_relation_sequence[t], candidate_entity_sequence[t], current_entities[t], states,
+                prev_relations, query_embeddings)
+            all_loss.append(loss)
+            all_logits.append(logits)
+            actions_idx.append(idx)
+        return all_loss, all_logits, actions_idx
+
+
+def benchmark(params, num_batches=20):
+    """Times the hop-by-hop rollouts of the TF1 partial_run loop and of CompiledAgent.step on the same episodes,
+    after loading the TF1 variables into the CompiledAgent through a checkpoint, and checks that both give the same
+    log-probabilities
+    """
+    from MARS.moa_retrieval_system.agent import Agent
+    from MARS.moa_retrieval_system.environment import Env
+
+    environment = Env(params, 'train')
+    episodes = environment.get_episodes()
+    path_length = params['path_length']
+    checkpoint_path = params['output_dir'] + 'benchmark/model.ckpt'
+
+    with tf.Graph().as_default():
+        agent = Agent(params)
+        candidate_relations = [tf.compat.v1.placeholder(tf.int32, [None, params['max_branching']])
+                               for _ in range(path_length)]
+        candidate_entities = [tf.compat.v1.placeholder(tf.int32, [None, params['max_branching']])
+                              for _ in range(path_length)]
+        current_entities = [tf.compat.v1.placeholder(tf.int32, [None]) for _ in range(path_length)]
+        query_relations = tf.compat.v1.placeholder(tf.int32, [None])
+        range_arr = tf.compat.v1.placeholder(tf.int32, [None])
+        per_example_loss, per_example_logits, actions_idx = agent(candidate_relations, candidate_entities,
+                                                                  current_entities, query_relations, range_arr,
+                                                                  path_length)
+        fetches = per_example_loss + per_example_logits + actions_idx
+        feeds = candidate_relations + candidate_entities + current_entities + [query_relations, range_arr]
+        with tf.compat.v1.Session() as sess:
+            sess.run(tf.compat.v1.global_variables_initializer())
+            tf.compat.v1.train.Saver().save(sess, checkpoint_path)
+            # the first hop of every episode, to compare the log-probabilities of both agents
+            first_hops = []
+            start = time.perf_counter()
+            for _ in range(num_batches):
+                episode = next(episodes)
+                h = sess.partial_run_setup(fetches=fetches, feeds=feeds)
+                states = episode.get_states()
+                for i in range(path_length):
+                    feed_dict = {candidate_relations[i]: states['next_relations'],
+                                 candidate_entities[i]: states['next_entities'],
+                                 current_entities[i]: states['current_entities']}
+                    if i == 0:
+                        feed_dict[query_relations] = episode.get_query_relations()
+                        feed_dict[range_arr] = np.arange(states['current_entities'].shape[0])
+                    _, logits, idx = sess.partial_run(h, [per_example_loss[i], per_example_logits[i],
+                                                          actions_idx[i]], feed_dict=feed_dict)
+                    if i == 0:
+                        first_hops.append((dict(states), episode.get_query_relations(), logits))
+                    states = episode(idx)
+            partial_run_time = time.perf_counter() - start
+
+    compiled_agent = CompiledAgent(params)
+    compiled_agent.load_tf1_checkpoint(checkpoint_path)
+    # compile once before timing
+    compiled_agent.step(*compiled_step_inputs(compiled_agent, *first_hops[0][:2]))
+    start = time.perf_counter()
+    for _ in range(num_batches):
+        episode = next(episodes)
+        states = episode.get_states()
+        step_inputs = compiled_step_inputs(compiled_agent, states, episode.get_query_relations())
+        for i in range(path_length):
+            _, _, _, idx, prev_relations = compiled_agent.step(*step_inputs)
+            states = episode(idx.numpy())
+            step_inputs = (states['next_relations'], states['next_entities'], states['current_entities'],
+                           step_inputs[3], prev_relations, step_inputs[5])
+    compiled_time = time.perf_counter() - start
+
+    max_difference = max(np.abs(compiled_agent.step(*compiled_step_inputs(compiled_agent, states, query))[1].numpy() -
+                                logits).max() for states, query, logits in first_hops)
+    num_steps = num_batches * path_length
+    logger.info('partial_run loop: {0:.2f} steps/sec'.format(num_steps / partial_run_time))
+    logger.info('compiled step: {0:.2f} steps/sec'.format(num_steps / compiled_time))
+    logger.info('max difference of the log-probabilities: {0:.2e}'.format(max_difference))
+
+
+def compiled_step_inputs(compiled_agent, states, query_relations):
+    """Gets the inputs of CompiledAgent.step for the first hop of an episode"""
+    batch_size = states['current_entities'].shape[0]
+    return (states['next_relations'], states['next_entities'], states['current_entities'],
+            compiled_agent.zero_state(batch_size), np.full(batch_size, compiled_agent.dummy_start_relation),
+            tf.gather(compiled_agent.relation_lookup_table, query_relations))
+
+
+if __name__ == '__main__':
+    from MARS.options import read_options
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+    options = read_options()
+    # the first value of every option which can take several
+    options = {k: v[0] if isinstance(v, list) else v for k, v in options.items()}
+    vocab_dir = options['input_dir'] + 'vocab/'
+    options['relation_vocab'] = json.load(open(vocab_dir + 'relation_vocab.json'))
+    options['entity_vocab'] = json.load(open(vocab_dir + 'entity_vocab.json'))
+    options['output_dir'] = options['base_output_dir']
+    os.makedirs(options['output_dir'] + 'benchmark/', exist_ok=True)
+    benchmark(options)
@@ -1,5 +1,10 @@
+import os
+import time
+import queue
+import threading
 import numpy as np
-import networkx as nx
+import tensorflow as tf
+from MARS.data.cache import cache_key
 from MARS.data.grapher import RelationEntityGrapher
 from MARS.data.feed_data import RelationEntityBatcher
 
@@ -14,7 +19,7 @@ class Episode(object):
             - e1: a list of source nodes taking part in batch triples
             - r: a list of all relations taking part in batch triples
             - e2: a list of sink nodes taking part in batch triples
-            - all_answers: a mapping from sink nodes (keys) to tuples of source nodes and relations from which they are reachable
+            - all_answers: a padded array holding, for each query, all sink nodes reachable from its source node and relation
         :param params: user specified configs
         """
         self.grapher = graph
@@ -40,13 +45,24 @@ class Episode(object):
         self.current_entities = np.repeat(start_entities, self.rollouts)
         self.all_answers = all_answers
 
-        # this returns the self.array_store from grapher which tells us all next possible moves
-        next_actions = self.grapher.return_next_actions(self.current_entities, self.start_entities,
-                                                        self.query_relations, self.end_entities, self.all_answers,
-                                                        self.current_hop == self.path_len - 1, self.rollouts)
+        # the number of rows for which next actions were requested, and the number of unique rows actually computed
+        self.action_rows = 0
+        self.unique_action_rows = 0
         self.states = dict()
-        self.states['next_relations'] = next_actions[:, :, 1]
-        self.states['next_entities'] = next_actions[:, :, 0]
+        # this returns the action tables from grapher which tell us all next possible moves
+        self.update_next_actions()
+
+    def update_next_actions(self):
+        """Gets the next possible moves from the grapher, which computes them once per unique (query, entity) pair,
+            and broadcasts them back to all rows of the batch
+        """
+        next_entities, next_relations, row_index = self.grapher.return_next_actions(
+            self.current_entities, self.start_entities, self.query_relations, self.end_entities, self.all_answers,
+            self.current_hop == self.path_len - 1, self.rollouts)
+        self.action_rows += row_index.shape[0]
+        self.unique_action_rows += next_entities.shape[0]
+        self.states['next_relations'] = next_relations[row_index]
+        self.states['next_entities'] = next_entities[row_index]
         self.states['current_entities'] = self.current_entities
 
     def get_states(self):
@@ -74,19 +90,168 @@ class Episode(object):
         self.current_hop += 1
         # NOTE: self.no_examples * self.rollouts is the num of starting entities times the number of times a query is done
         self.current_entities = self.states['next_entities'][np.arange(self.no_examples * self.rollouts), action]
-        next_actions = self.grapher.return_next_actions(self.current_entities, self.start_entities,
-                                                        self.query_relations, self.end_entities, self.all_answers,
-                                                        self.current_hop == self.path_len - 1, self.rollouts)
         # update the states
-        self.states['next_relations'] = next_actions[:, :, 1]
-        self.states['next_entities'] = next_actions[:, :, 0]
-        self.states['current_entities'] = self.current_entities
+        self.update_next_actions()
         return self.states
 
 
+class EpisodePrefetcher(object):
+    """Prepares the next episodes (batch sampling and the first action tables) in a background thread,
+    while the agent is still playing the current one
+    """
+    # put on the queue by the producer when it runs out of episodes
+    END = object()
+
+    def __init__(self, episodes, depth, mode):
+        """Starts the producer thread
+        :param episodes: the generator of episodes to draw from
+        :param depth: the max number of prepared episodes waiting in the queue
+        :param mode: 'train', 'dev' or 'test', for the report
+        """
+        self.episodes = episodes
+        self.mode = mode
+        self.queue = queue.Queue(maxsize=depth)
+        self.stop_event = threading.Event()
+        self.num_episodes = 0
+        self.produce_time = 0.0  # the time the producer spent preparing episodes
+        self.full_time = 0.0  # the time the producer waited on a full queue, i.e. for the model
+        self.stall_time = 0.0  # the time the consumer waited on an empty queue, i.e. for the environment
+        self.start_time = time.perf_counter()
+        self.thread = threading.Thread(target=self.produce, daemon=True)
+        self.thread.start()
+
+    def put(self, item):
+        """Puts an item on the queue, unless the consumer has stopped in the meantime"""
+        while not self.stop_event.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def produce(self):
+        try:
+            while not self.stop_event.is_set():
+                start = time.perf_counter()
+                episode = next(self.episodes, self.END)
+                self.produce_time += time.perf_counter() - start
+                if episode is self.END:
+                    break
+                start = time.perf_counter()
+                self.put(episode)
+                self.full_time += time.perf_counter() - start
+        except Exception as error:
+            # hand the error over to the consumer, where it is raised again
+            self.put(error)
+        self.put(self.END)
+
+    def __iter__(self):
+        try:
+            while True:
+                start = time.perf_counter()
+                item = self.queue.get()
+                self.stall_time += time.perf_counter() - start
+                if item is self.END:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                self.num_episodes += 1
+                yield item
+        finally:
+            self.close()
+
+    def close(self):
+        """Stops the producer thread, e.g. when the consumer stops early"""
+        self.stop_event.set()
+        self.thread.join()
+
+    def report(self):
+        """Summarizes the throughput of the producer, and whether the environment or the model is the bottleneck"""
+        elapsed = time.perf_counter() - self.start_time
+        return '{0} episodes: {1} in {2:.1f}s ({3:.2f}/s); producer busy {4:.2f}s, blocked on a full queue {5:.2f}s; ' \
+               'consumer stalled on an empty queue {6:.2f}s'.format(self.mode, self.num_episodes, elapsed,
+                                                                    self.num_episodes / max(elapsed, 1e-9),
+                                                                    self.produce_time, self.full_time, self.stall_time)
+
+
+class InGraphEnvironment(object):
+    """The next-action lookup and masking of RelationEntityGrapher.return_next_actions, built as TF ops, so that
+    the agent can step through the KG inside the TF graph without returning to Python after every hop
+    """
+    def __init__(self, grapher, rollouts):
+        """Creates the action tables and the placeholders of the batch
+        :param grapher: the RelationEntityGrapher holding the action tables
+        :param rollouts: the number of consecutive rows which belong to the same query
+        """
+        self.grapher = grapher
+        self.rollouts = rollouts
+        self.ePAD = grapher.ePAD
+        self.rPAD = grapher.rPAD
+        with tf.compat.v1.variable_scope('in_graph_environment'):
+            # the action tables are local variables, so they are neither saved with the model nor re-initialized
+            # with it, and are loaded once with initialize
+            self.entity_store_placeholder = tf.compat.v1.placeholder(tf.int32, grapher.entity_store.shape)
+            self.relation_store_placeholder = tf.compat.v1.placeholder(tf.int32, grapher.relation_store.shape)
+            self.entity_store = tf.compat.v1.Variable(self.entity_store_placeholder, trainable=False,
+                                                      collections=[tf.compat.v1.GraphKeys.LOCAL_VARIABLES],
+                                                      name='entity_store')
+            self.relation_store = tf.compat.v1.Variable(self.relation_store_placeholder, trainable=False,
+                                                        collections=[tf.compat.v1.GraphKeys.LOCAL_VARIABLES],
+                                                        name='relation_store')
+            # the triples of the batch, repeated for each rollout, and the padded answers (-1 as padding) of each query
+            self.start_entities = tf.compat.v1.placeholder(tf.int32, [None], name='start_entities')
+            self.end_entities = tf.compat.v1.placeholder(tf.int32, [None], name='end_entities')
+            self.all_answers = tf.compat.v1.placeholder(tf.int32, [None, None], name='all_answers')
+
+    def initialize(self, sess):
+        """Loads the action tables of the grapher into the TF graph"""
+        sess.run([self.entity_store.initializer, self.relation_store.initializer],
+                 feed_dict={self.entity_store_placeholder: self.grapher.entity_store.astype(np.int32),
+                            self.relation_store_placeholder: self.grapher.relation_store.astype(np.int32)})
+
+    def next_actions(self, current_entities, query_relations, is_last_step):
+        """Builds the ops which return the actions that could be taken from the current entities, with the query triple
+            and the other correct answers masked, like RelationEntityGrapher.return_next_actions
+        :param current_entities: tensor of the entity each row currently sits on
+        :param query_relations: tensor of the query relation of each row
+        :param is_last_step: boolean indicating whether it's the max path length
+
+        :returns: the tensors of the next entities and the next relations, each [rows, max_branching]
+        """
+        entities = tf.gather(self.entity_store, current_entities)
+        relations = tf.gather(self.relation_store, current_entities)
+        end_entities = tf.expand_dims(self.end_entities, 1)
+        # for the rows still at their beginning node, mask the query triple itself
+        at_start = tf.expand_dims(tf.equal(current_entities, self.start_entities), 1)
+        mask = at_start & tf.equal(relations, tf.expand_dims(query_relations, 1)) & tf.equal(entities, end_entities)
+        if is_last_step:
+            # hide correct answers which are not the current sink node; every (query, entity) pair is encoded
+            # as one integer and looked up in the sorted keys of all answers
+            num_entities = tf.shape(self.entity_store, out_type=tf.int64)[0]
+            answers = tf.cast(self.all_answers, tf.int64)
+            answer_idx = tf.expand_dims(tf.range(tf.shape(answers, out_type=tf.int64)[0]), 1)
+            answer_keys = tf.sort(tf.boolean_mask(answer_idx * num_entities + answers, answers >= 0))
+            # a sentinel larger than all keys, so that every search position is valid
+            answer_keys = tf.concat([answer_keys, [tf.int64.max]], axis=0)
+            row_query_idx = tf.range(tf.shape(current_entities, out_type=tf.int64)[0]) // self.rollouts
+            keys = tf.expand_dims(row_query_idx, 1) * num_entities + tf.cast(entities, tf.int64)
+            positions = tf.searchsorted(tf.expand_dims(answer_keys, 0), tf.reshape(keys, [1, -1]))
+            is_answer = tf.reshape(tf.equal(tf.gather(answer_keys, positions[0]), tf.reshape(keys, [-1])),
+                                   tf.shape(keys))
+            mask = mask | (is_answer & tf.not_equal(entities, end_entities))
+        entities = tf.compat.v1.where(mask, tf.fill(tf.shape(entities), self.ePAD), entities)
+        relations = tf.compat.v1.where(mask, tf.fill(tf.shape(relations), self.rPAD), relations)
+        return entities, relations
+
+
 class Env(object):
     """sets up the whole environment in which the agent will work"""
-    def __init__(self, params, mode='train'):
+    def __init__(self, params, mode='train', grapher=None):
+        """Sets up the graph and the data batcher for one of the data splits
+        :param params: user specified configs
+        :param mode: 'train', 'dev' or 'test'
+        :param grapher: (optional) an already built RelationEntityGrapher to share, e.g. the one of the train environment
+        """
         self.batch_size = params['batch_size']
         self.num_rollouts = params['num_rollouts']
         self.test_rollouts = params['test_rollouts']
@@ -94,48 +259,57 @@ class Env(object):
         self.negative_reward = params['negative_reward']
         self.mode = mode
         self.path_len = params['path_length']
+        self.prefetch_depth = params['prefetch_depth']
+        # the prefetcher of the latest call of get_episodes, if episodes are prefetched
+        self.prefetcher = None
         input_dir = params['input_dir']
         output_dir = params['base_output_dir']
-        triple_store = input_dir + 'graph.txt'
-        nx_output = output_dir + 'nx_graph.graphml'
-        pruned_output = output_dir + 'pruned_graph.graphml'
-        np_output = output_dir + 'np_graph.npy'
+        if params['derive_inverses']:
+            # only the forward triples are read, and the inverse edges are added while building the graph
+            triple_store = input_dir + 'graph_triples.txt'
+        else:
+            triple_store = input_dir + 'graph.txt'
 
-        # create the KG
-        if mode == 'train':
-            self.grapher = RelationEntityGrapher(triple_store=triple_store,
-                                                entity_vocab=params['entity_vocab'],
-                                                relation_vocab=params['relation_vocab'],
-                                                max_branching=params['max_branching'],
-                                                graph_output_file=nx_output,
-                                                pruned_output_file=pruned_output,
-                                                np_graph_file=np_output,
-                                                class_threshhold=params['class_threshhold'])
-            
+        # the directory of the caches which can be shared by all runs on the same data
+        shared_cache_dir = params['graph_cache_dir'] or input_dir + 'cache/'
+        os.makedirs(shared_cache_dir, exist_ok=True)
+
+        if grapher is not None:
+            # the grapher is never modified after it is built, so all environments can share one instance
+            self.grapher = grapher
         else:
+            # the built graph is cached under a key made from all of its inputs, so the dev/test environments,
+            # replicates and other grid permutations with the same inputs can load it instead of re-building it
+            key = cache_key(files=[triple_store],
+                            objects=[params['entity_vocab'], params['relation_vocab'], params['max_branching'],
+                                     params['class_threshhold'], params['seed'], params['derive_inverses']])
+            if params['seed'] is None:
+                # without a seed, the branching selection is random, so only re-use the graph within this run
+                cache_dir = params['output_dir']
+            else:
+                cache_dir = shared_cache_dir
+
+            # create the KG, or load it from the cache
             self.grapher = RelationEntityGrapher(triple_store=triple_store,
-                                                entity_vocab=params['entity_vocab'],
-                                                relation_vocab=params['relation_vocab'],
-                                                max_branching=params['max_branching'],
-                                                nx_graph_obj=nx.read_graphml(nx_output,
-                                                                             node_type=int,
-                                                                             edge_key_type=int,
-                                                                             force_multigraph=True),
-                                                pruned_graph_obj=nx.read_graphml(pruned_output,
-                                                                             node_type=int,
-                                                                             edge_key_type=int,
-                                                                             force_multigraph=True),
-                                                np_graph_array=np.load(np_output))
+                                                 entity_vocab=params['entity_vocab'],
+                                                 relation_vocab=params['relation_vocab'],
+                                                 max_branching=params['max_branching'],
+                                                 class_threshhold=params['class_threshhold'],
+                                                 cache_file=cache_dir + f'graph_{key}',
+                                                 seed=params['seed'],
+                                                 derive_inverses=params['derive_inverses'])
 
-        
         self.batcher = RelationEntityBatcher(input_dir=input_dir,
                                                 batch_size=params['batch_size'],
                                                 entity_vocab=params['entity_vocab'],
                                                 relation_vocab=params['relation_vocab'],
                                                 path_len=self.path_len,
-                                                nx_graph=self.grapher.return_directed_graph(),
+                                                graph=self.grapher.return_directed_graph(),
                                                 mode=mode,
-                                                output_dir=output_dir)
+                                                output_dir=output_dir,
+                                                cache_dir=shared_cache_dir,
+                                                graph_file=triple_store,
+                                                inverse_relations=self.grapher.inverse_relations)
         
         if mode != 'train':       
             self.total_no_examples = self.batcher.store.shape[0]
@@ -143,6 +317,13 @@ class Env(object):
 
 
     def get_episodes(self):
+        """Generates the episodes of this environment; if prefetch_depth > 0, they are prepared in the background"""
+        if self.prefetch_depth > 0:
+            self.prefetcher = EpisodePrefetcher(self.generate_episodes(), self.prefetch_depth, self.mode)
+            return iter(self.prefetcher)
+        return self.generate_episodes()
+
+    def generate_episodes(self):
         params = self.batch_size, self.path_len, self.num_rollouts, self.test_rollouts, self.positive_reward, \
                  self.negative_reward, self.mode, self.batcher
         if self.mode == 'train':
@@ -0,0 +1,42 @@
+import tensorflow as tf
+
+
+"""An Adam optimizer whose updates from sparse gradients (e.g., of embedding lookups) only touch the rows in the batch"""
+
+
+class LazyAdamOptimizer(tf.compat.v1.train.AdamOptimizer):
+    """Like tf.compat.v1.train.AdamOptimizer, except for gradients which are IndexedSlices: AdamOptimizer decays the
+    moments of every row of the variable and moves every row, so the cost of a step grows with the size of the
+    embedding tables. Here, only the moments and values of the rows with a gradient are updated, as in the former
+    tf.contrib.opt.LazyAdamOptimizer. Dense gradients get the same updates as with AdamOptimizer.
+    """
+    def _apply_sparse(self, grad, var):
+        return self.apply_rows(grad.values, var, grad.indices)
+
+    def _resource_apply_sparse(self, grad, var, indices):
+        return self.apply_rows(grad, var, indices)
+
+    def apply_rows(self, grad_rows, var, indices):
+        """Updates the given rows of a variable and of its moments
+        :param grad_rows: the gradients of the rows
+        :param var: the variable
+        :param indices: the unique indices of the rows (the base class sums the gradients of duplicate indices)
+        """
+        dtype = var.dtype.base_dtype
+        beta1_power, beta2_power = [tf.cast(power, dtype) for power in self._get_beta_accumulators()]
+        lr_t = tf.cast(self._lr_t, dtype)
+        beta1_t = tf.cast(self._beta1_t, dtype)
+        beta2_t = tf.cast(self._beta2_t, dtype)
+        epsilon_t = tf.cast(self._epsilon_t, dtype)
+        lr = lr_t * tf.sqrt(1 - beta2_power) / (1 - beta1_power)
+
+        # m_t = beta1 * m + (1 - beta1) * g_t, and v_t = beta2 * v + (1 - beta2) * g_t^2, for the given rows only
+        m = self.get_slot(var, 'm')
+        v = self.get_slot(var, 'v')
+        m_rows = beta1_t * tf.gather(m, indices) + (1 - beta1_t) * grad_rows
+        v_rows = beta2_t * tf.gather(v, indices) + (1 - beta2_t) * tf.square(grad_rows)
+        m_t = tf.compat.v1.scatter_update(m, indices, m_rows, use_locking=self._use_locking)
+        v_t = tf.compat.v1.scatter_update(v, indices, v_rows, use_locking=self._use_locking)
+        var_update = tf.compat.v1.scatter_sub(var, indices, lr * m_rows / (tf.sqrt(v_rows) + epsilon_t),
+                                              use_locking=self._use_locking)
+        return tf.group(var_update, m_t, v_t)
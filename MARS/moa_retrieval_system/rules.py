@@ -1,26 +1,12 @@
 import numpy as np
-from copy import deepcopy
-from collections import Counter
 
 """Script containing functions to check whether metapaths match with rules, and 
     modify the reward accordingly
 """
 
-"""The following three functions are used to update the rule confidences based on the P2H empirical probabilities"""
+"""The following functions are used to update the rule confidences based on the P2H empirical probabilities"""
 
 
-def sum_dicts(dict1, dict2):
-    """Gets the sum of the values in the two dicts"""
-    new_dict = dict()
-    for key in set(dict1.keys()) & set(dict2.keys()):
-        new_dict[key] = dict1[key] + dict2[key]
-    for key in set(dict1.keys()) - set(dict2.keys()):
-        new_dict[key] = dict1[key]
-    for key in set(dict2.keys()) - set(dict1.keys()):
-        new_dict[key] = dict2[key]
-    return new_dict
-        
-
 def get_metapath_chunks(path):
     """Gets all of the two-hop pieces of a metapath, returns them as a dictionary like (rel1, rel2):occurences """
     chunks_dict = dict()
@@ -42,73 +28,42 @@ def get_metapath_chunks(path):
     return chunks_dict
 
 
-def p2h_probability(mpath, empirical_probs):
-    """Compute the P2H probability of a metapath, given the empirical probabilities of its two-hop chunks
-    :param mpath: the full metapath, in terms the relations it constitutes
-    :param empirical_probs: the dictionary of batch-specific empirical probabilities of length-2 metapaths
-    """
-    prob = 1
-    chunks = get_metapath_chunks(mpath)
-    for key, val in chunks.items():
-        chunk_prob = empirical_probs[key] if key in empirical_probs else 0
-        prob *= chunk_prob ** val
-    return prob
-
-
-def update_confs_P2H(rule_dict, empirical_probs, alpha=0.1, min_ratio=0.001, max_ratio=1000):
-    """Updates the confidences in the rule list based on P2H empirical probabilities computed during the batch
-    :param rule_dict: the rules and corresponding confidences
-    :param empirical_probs: the dictionary of batch-specific empirical probabilities of length-2 metapaths
+def update_confs_P2H(rule_set, empirical_probs, alpha=0.1, min_ratio=0.001, max_ratio=1000):
+    """Updates the confidences in the rule set based on P2H empirical probabilities computed during the batch
+    :param rule_set: the RuleSet holding the rules and corresponding confidences
+    :param empirical_probs: array of the batch-specific empirical probability of each 2-hop chunk ID of the rule set
     :param alpha: the parameter that controls how drastically the confidences are updated
     :param min_ratio: the minimum ratio of observed to expected probability that is allowed (prevents zero division)
     :param max_ratio: the maximum ratio of observed to expected probability that is allowed (prevents extreme values)
     """
-    expected = 1 / len(empirical_probs)  ## the expected probability of each chunk
-    for rule_head in rule_dict.keys():
-        for rule_body_num, mpath in enumerate(rule_dict[rule_head]):
-            old_conf = float(rule_dict[rule_head][rule_body_num][0])
-            # get the P2H probability
-            p2h_prob = p2h_probability(mpath[2::], empirical_probs)
-            normed_prob = p2h_prob / (expected ** (len(mpath[2::])-1))  ## normalize it by the prob we expect
-            # get new confidence value
-            adjustment = map_ratio_to_penalty(normed_prob, alpha, min_ratio, max_ratio)
-            new_conf = old_conf + (old_conf * adjustment)
-            rule_dict[rule_head][rule_body_num][0] = str(max(min(1, new_conf), 0))  # bounds it between 0 and 1
-    return rule_dict
-
-
-def update_confs_basic(rule_dict, no_rule_instances, rule_count, alpha=0.1, min_ratio=0.001, max_ratio=1000):
+    # get the P2H probabilities, normalized by the probs we expect
+    normed_probs = rule_set.p2h_ratios(empirical_probs)
+    rule_set.adjust_confidences(map_ratio_to_penalty(normed_probs, alpha, min_ratio, max_ratio))
+
+
+def update_confs_basic(rule_set, rule_instances, rule_count, alpha=0.1, min_ratio=0.001, max_ratio=1000):
     """Updates confidences the basic way, based on number of occurrences of each rule
-    :param rule_dict: the rules and corresponding confidences
-    :param no_rule_instances: the number of instances of each rule
+    :param rule_set: the RuleSet holding the rules and corresponding confidences
+    :param rule_instances: array of the number of instances of each rule
     :param alpha: the parameter that controls how drastically the confidences are updated
     :param min_ratio: the minimum ratio of observed to expected probability that is allowed (prevents zero division)
     :param max_ratio: the maximum ratio of observed to expected probability that is allowed (prevents extreme values)
     """
-    num_rules = len(sum([val for val in rule_dict.values()], []))
-    expected_prob = 1 / num_rules
-
-    for rule_head, rule_bodies in no_rule_instances.items():
-        for rule_body_num, num_instances in rule_bodies.items():
-            observed_prob = num_instances / rule_count
-            normed_prob = observed_prob / expected_prob
-            adjustment = map_ratio_to_penalty(normed_prob, alpha, min_ratio, max_ratio)
-            old_conf = float(rule_dict[rule_head][rule_body_num][0])
-            new_conf = old_conf + (old_conf * adjustment)
-            rule_dict[rule_head][rule_body_num][0] = str(max(min(1, new_conf), 0))  # bounds it between 0 and 1
+    expected_prob = 1 / len(rule_set)
+    observed_probs = rule_instances / rule_count
+    normed_probs = observed_probs / expected_prob
+    rule_set.adjust_confidences(map_ratio_to_penalty(normed_probs, alpha, min_ratio, max_ratio))
 
-    return rule_dict
 
-
-def update_confs_mixed(rule_dict, no_rule_instances, rule_count, empirical_probs,
+def update_confs_mixed(rule_set, rule_instances, rule_count, empirical_probs,
                        alpha=0.1, min_ratio_naive=0.001, max_ratio_naive=1000, 
                        min_ratio_p2h=0.001, max_ratio_p2h=1000, 
                        mixing_ratio=0.5):
-    """Updates the confidences in the rule list based on a mix between 
+    """Updates the confidences in the rule set based on a mix between 
                     P2H empirical probabilities and frequency-based probabilities
-    :param rule_dict: the rules and corresponding confidences
-    :param no_rule_instances: the number of instances of each rule
-    :param empirical_probs: the dictionary of batch-specific empirical probabilities of length-2 metapaths
+    :param rule_set: the RuleSet holding the rules and corresponding confidences
+    :param rule_instances: array of the number of instances of each rule
+    :param empirical_probs: array of the batch-specific empirical probability of each 2-hop chunk ID of the rule set
     :param alpha: the parameter that controls how drastically the confidences are updated
     :param min_ratio_naive: the minimum ratio of observed to expected probability that is allowed (prevents zero division)
     :param max_ratio_naive: the maximum ratio of observed to expected probability that is allowed (prevents extreme values)
@@ -116,41 +71,22 @@ def update_confs_mixed(rule_dict, no_rule_instances, rule_count, empirical_probs
     :param max_ratio_p2h: the maximum ratio of observed to expected probability that is allowed (prevents extreme values)
     :param mixing_ratio: the ratio of the first penalty to the second penalty; default of 0.5 means equal weighting
     """
-    expected_p2h = 1 / len(empirical_probs)  ## the expected probability of each chunk
-    num_rules = len(sum([val for val in rule_dict.values()], []))
-    expected_naive = 1 / num_rules  ## the expected probability of each rule
-
-    for rule_head, rule_bodies in no_rule_instances.items():
-
-        adjustment_dict = dict()
-
-        for rule_body_num, num_instances in rule_bodies.items():
-            # frequency-based updates:
-            observed_naive = num_instances / rule_count
-            normed_naive = observed_naive / expected_naive
-            adjustment_naive = map_ratio_to_penalty(normed_naive, alpha, min_ratio_naive, max_ratio_naive)
-            adjustment_dict[rule_body_num] = adjustment_naive
-
-        # P2H-based updates:
-        for rule_body_num, mpath in enumerate(rule_dict[rule_head]):
-            p2h_prob = p2h_probability(mpath[2::], empirical_probs)
-            normed_p2h = p2h_prob / (expected_p2h ** (len(mpath[2::])-1))  ## normalize it by the prob we expect
-            # get new confidence value
-            adjustment_p2h = map_ratio_to_penalty(normed_p2h, alpha, min_ratio_p2h, max_ratio_p2h)
-            adjustment_dict[rule_body_num] = mix_penalties(adjustment_dict[rule_body_num], 
-                                                                        adjustment_p2h, mixing_ratio)
-            
-        for rule_body_num, adjustment in adjustment_dict.items():
-            old_conf = float(rule_dict[rule_head][rule_body_num][0])
-            new_conf = old_conf + (old_conf * adjustment)
-            rule_dict[rule_head][rule_body_num][0] = str(max(min(1, new_conf), 0))
-
-    return rule_dict
-
-    
+    expected_naive = 1 / len(rule_set)  ## the expected probability of each rule
+
+    # frequency-based updates:
+    observed_naive = rule_instances / rule_count
+    normed_naive = observed_naive / expected_naive
+    adjustments_naive = map_ratio_to_penalty(normed_naive, alpha, min_ratio_naive, max_ratio_naive)
+
+    # P2H-based updates:
+    normed_p2h = rule_set.p2h_ratios(empirical_probs)
+    adjustments_p2h = map_ratio_to_penalty(normed_p2h, alpha, min_ratio_p2h, max_ratio_p2h)
+
+    rule_set.adjust_confidences(mix_penalties(adjustments_naive, adjustments_p2h, mixing_ratio))
+
 
 def map_ratio_to_penalty(ratio, alpha=0.1, min_ratio=0.001, max_ratio=1000):
-    """This function maps an observed/expected ratio to some penalty (-1, 1)
+    """This function maps an observed/expected ratio (or an array of them) to some penalty (-1, 1)
     in which a ratio > 1 gets a positive penalty, and 
     a ratio < 1 gets a negative penalty. 
     The penalty is scaled by alpha, so that the penalty is less dramatic.
@@ -160,7 +96,7 @@ def map_ratio_to_penalty(ratio, alpha=0.1, min_ratio=0.001, max_ratio=1000):
     :param max_ratio: the maximum ratio of observed to expected probability that is allowed (prevents extreme values)
     """
     # Ensure ratio is within a valid range
-    ratio = max(min_ratio, min(max_ratio, ratio))  # Avoid division by zero and extreme values
+    ratio = np.maximum(min_ratio, np.minimum(max_ratio, ratio))  # Avoid division by zero and extreme values
 
     # Map ratio to penalty between -1 and 1
     penalty = 2 * (ratio - 1) / (ratio + 1)
@@ -190,35 +126,172 @@ def prepare_argument(argument, string='NO_OP'):
     return body, argument[-1]  # return relation sequence, last entity
 
 
-def check_rule(body, obj, obj_string, rule, only_body):
+class RuleSet(object):
+    """The rules and their confidences. The rules get a flat index, which counts them in the order of the rule heads
+    and, within a head, in the order of their bodies; the confidences are one array in that order, and are updated
+    in place. The dictionary of the rules file is only used to create the rule set and to write it back.
+    The rule bodies are also compiled once into relation ID sequences, so that the paths of a whole batch are matched
+    against them with array operations. A body is compiled without its NO_OPs, in the same way as a path is compared
+    to it.
     """
-    Compare the argument with a rule. only_body=False checks whether the end entity makes it a true pair
-    """
-    if only_body:  # Compare only the body of the rule to the argument
-        retval = (body == rule[2:])
-    else:
-        retval = ((body == rule[2:]) and (obj == obj_string))  # checks if the end entity is correct
-    return retval
-
-
-def init_empirical_nums(rule_dict):
-    """Initializes the empirical nums dict, where each 2-hop chunk is assigned to a value of zero."""
-    empirical_nums = dict()
-    for head in rule_dict.keys():
-        for count, mpath in enumerate(rule_dict[head]):
-            empirical_nums = Counter(get_metapath_chunks(mpath[2::])) + Counter(empirical_nums)
-
-    empirical_nums = {key: 0 for key in empirical_nums.keys()}
-    return empirical_nums
-
-
-def modify_rewards(rule_list, arguments, query_rel_string, obj_string, Lambda, 
+    def __init__(self, rule_dict, relation_vocab, path_length, no_op='NO_OP'):
+        """:param rule_dict: dictionary mapping each rule head to its rules [confidence, head, body relations...]
+        :param relation_vocab: dictionary mapping the relations to their unique IDs
+        :param path_length: the number of hops of the paths which are matched
+        :param no_op: the relation which is skipped in paths and rule bodies
+        """
+        self.heads = list(rule_dict.keys())
+        self.head_ids = {head: h for h, head in enumerate(self.heads)}
+        num_bodies = np.array([len(rules) for rules in rule_dict.values()], dtype=np.int64)
+        # the rules of the i-th head are the flat indices head_offsets[i]:head_offsets[i + 1]
+        self.head_offsets = np.zeros(len(self.heads) + 1, dtype=np.int64)
+        np.cumsum(num_bodies, out=self.head_offsets[1:])
+        self.rule_heads = np.repeat(np.arange(len(self.heads)), num_bodies)
+        self.bodies = [list(rule[2:]) for rules in rule_dict.values() for rule in rules]
+        self.body_lengths = np.array([len(body) for body in self.bodies], dtype=np.int64)
+        self.confidences = np.array([float(rule[0]) for rules in rule_dict.values() for rule in rules],
+                                    dtype=np.float64)
+
+        self.no_op = relation_vocab[no_op]
+        self.path_length = path_length
+        # the digits of a key are the relation IDs shifted by one, so that 0 pads bodies shorter than the paths
+        self.base = len(relation_vocab) + 1
+        if self.base ** (path_length + 1) >= np.iinfo(np.int64).max:
+            raise ValueError(f'Paths of {path_length} hops over {len(relation_vocab)} relations do not fit in '
+                             f'64-bit rule keys.')
+        # the flat index of the rule matched by each (head, body) pair
+        self.body_rules = dict()
+        for i, body in enumerate(self.bodies):
+            head = self.heads[self.rule_heads[i]]
+            # a body with a NO_OP, longer than the paths or with unknown relations never equals a path
+            if no_op in body or len(body) > path_length or any(rel not in relation_vocab for rel in [head] + body):
+                continue
+            # only the first of several rules with the same head and body is ever matched
+            self.body_rules.setdefault((head, tuple(body)), i)
+        digits = np.zeros((len(self.body_rules), path_length + 1), dtype=np.int64)
+        for row, (head, body) in enumerate(self.body_rules.keys()):
+            digits[row, 0] = relation_vocab[head] + 1
+            digits[row, 1:len(body) + 1] = [relation_vocab[rel] + 1 for rel in body]
+        keys = self.encode(digits)
+        order = np.argsort(keys)
+        # the sorted keys of the (head, body) pairs, and the flat index of the rule which each one matches
+        self.keys = keys[order]
+        self.key_rules = np.fromiter(self.body_rules.values(), dtype=np.int64, count=len(self.body_rules))[order]
+
+        # the 2-hop chunks of the rule bodies (see get_metapath_chunks) get IDs in the order in which they occur
+        body_chunks = [get_metapath_chunks(body) for body in self.bodies]
+        self.chunk_ids = dict()
+        for chunks in body_chunks:
+            for key in chunks:
+                self.chunk_ids.setdefault(key, len(self.chunk_ids))
+        # the number of occurrences of each chunk in each rule body
+        self.chunk_counts = np.zeros((len(self.bodies), len(self.chunk_ids)), dtype=np.float64)
+        for i, chunks in enumerate(body_chunks):
+            for key, val in chunks.items():
+                self.chunk_counts[i, self.chunk_ids[key]] = val
+        # the sorted keys of the relation pairs of the chunks, packed like two digits of a rule key,
+        # and the ID of the chunk of each one
+        pairs = [(key, chunk) for key, chunk in self.chunk_ids.items() if all(rel in relation_vocab for rel in key)]
+        pair_keys = np.array([(relation_vocab[rel1] + 1) * self.base + relation_vocab[rel2] + 1
+                              for (rel1, rel2), _ in pairs], dtype=np.int64)
+        order = np.argsort(pair_keys)
+        self.pair_keys = pair_keys[order]
+        self.pair_chunks = np.array([chunk for _, chunk in pairs], dtype=np.int64)[order]
+
+    def __len__(self):
+        return self.confidences.shape[0]
+
+    def __contains__(self, head):
+        return head in self.head_ids
+
+    def to_dict(self):
+        """Gets the rules with their current confidences as a dictionary, in the format of the rules file"""
+        return {head: [[float(self.confidences[i]), head] + self.bodies[i]
+                       for i in range(self.head_offsets[h], self.head_offsets[h + 1])]
+                for h, head in enumerate(self.heads)}
+
+    def adjust_confidences(self, adjustments):
+        """Changes every confidence by the given fraction of itself, bounded between 0 and 1
+        :param adjustments: array of the adjustment of each rule
+        """
+        new_confidences = self.confidences + (self.confidences * adjustments)
+        self.confidences[:] = np.maximum(np.minimum(1, new_confidences), 0)
+
+    def encode(self, digits):
+        """Packs each row of a [rows, path_length + 1] array of digits into one integer key"""
+        keys = np.zeros(digits.shape[0], dtype=np.int64)
+        for column in range(digits.shape[1]):
+            keys = keys * self.base + digits[:, column]
+        return keys
+
+    def find(self, head, body):
+        """Gets the flat index of the first rule with the given head and body (relation names without NO_OPs),
+        or -1 if there is no such rule
+        """
+        return self.body_rules.get((head, tuple(body)), -1)
+
+    def strip_no_ops(self, relation_trajectory):
+        """Moves the relations other than NO_OP to the front of each path, keeping their order
+        :param relation_trajectory: [paths, path_length] array of the relation IDs chosen at each hop
+        :returns: [paths, path_length] array of the digits of the relations (see encode), padded with 0
+        """
+        relation_trajectory = np.asarray(relation_trajectory, dtype=np.int64)
+        is_no_op = relation_trajectory == self.no_op
+        order = np.argsort(is_no_op, axis=1, kind='stable')
+        body = np.take_along_axis(relation_trajectory + 1, order, axis=1)
+        body[np.take_along_axis(is_no_op, order, axis=1)] = 0
+        return body
+
+    def match(self, query_relations, relation_trajectory):
+        """Finds the rule which each path matches
+        :param query_relations: array of the query relation ID of each path
+        :param relation_trajectory: [paths, path_length] array of the relation IDs chosen at each hop
+        :returns: for each path, the flat index of the first rule with the query relation as its head and the
+            relations of the path (without NO_OPs) as its body, or -1 if there is no such rule
+        """
+        body = self.strip_no_ops(relation_trajectory)
+        keys = self.encode(np.concatenate([np.asarray(query_relations, dtype=np.int64)[:, np.newaxis] + 1, body],
+                                          axis=1))
+        if self.keys.shape[0] == 0:
+            return np.full(keys.shape[0], -1, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self.keys, keys), self.keys.shape[0] - 1)
+        return np.where(self.keys[positions] == keys, self.key_rules[positions], -1)
+
+    def count_chunks(self, relation_trajectory):
+        """Counts the 2-hop chunks of the rule bodies in the given paths, without their NO_OPs
+        :param relation_trajectory: [paths, path_length] array of the relation IDs chosen at each hop
+        :returns: array of the number of occurrences of each chunk ID
+        """
+        body = self.strip_no_ops(relation_trajectory)
+        pair_keys = (body[:, :-1] * self.base + body[:, 1:]).reshape(-1)
+        if self.pair_keys.shape[0] == 0:
+            return np.zeros(len(self.chunk_ids), dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self.pair_keys, pair_keys), self.pair_keys.shape[0] - 1)
+        found = self.pair_keys[positions] == pair_keys
+        return np.bincount(self.pair_chunks[positions[found]], minlength=len(self.chunk_ids))
+
+    def p2h_ratios(self, empirical_probs):
+        """Computes the P2H probability of every rule body, i.e., the product of the empirical probabilities of its
+        2-hop chunks, normalized by the probability expected if every chunk were equally likely.
+        The products are computed in log space, as one matrix product with the chunk counts of the bodies.
+        :param empirical_probs: array of the batch-specific empirical probability of each chunk ID
+        """
+        expected = 1 / empirical_probs.shape[0]  ## the expected probability of each chunk
+        # a body with a chunk which was not observed has a P2H probability of 0
+        unobserved = self.chunk_counts[:, empirical_probs <= 0].sum(axis=1) > 0
+        log_probs = np.log(np.where(empirical_probs > 0, empirical_probs, 1))
+        log_ratios = self.chunk_counts @ log_probs - (self.body_lengths - 1) * np.log(expected)
+        return np.where(unobserved, 0, np.exp(log_ratios))
+
+
+def modify_rewards(rule_set, query_relations, relation_trajectory, correct, Lambda,
                    rewards, only_body, update_confs, alpha, batch_size, rollouts, mixing_ratio):
-    """Modifies the rewards according to whether the metapath corresponds to a rule
-    :param rule_list: 2D array containing rules and corresponding confidences 
-    :param arguments: a string which is like a list, alternating between the next possible relation and entity
-    :param query_rel_string: all possible rule heads (relations) from each entity
-    :param obj_string: all possible sink entities from each sourch entity
+    """Modifies the rewards according to whether the metapath corresponds to a rule, and updates the confidences
+    of the rule set in place
+    :param rule_set: the RuleSet holding the rules and corresponding confidences
+    :param query_relations: array containing the query relation (i.e., the rule head) ID of each rollout
+    :param relation_trajectory: [rollouts, path_length] array of the relation IDs chosen at each hop
+    :param correct: boolean array marking the rollouts whose last entity is their sink entity
     :param Lambda: the reward value assigned for getting a matching path
     :param rewards: array containing rewards for each entity
     :param only_body: Either 0 or 1. Flag to check whether the extracted paths should only be compared against
@@ -232,46 +305,21 @@ def modify_rewards(rule_list, arguments, query_rel_string, obj_string, Lambda,
     :param rollouts: number of rollouts
     :param mixing_ratio: the ratio of the first penalty to the second penalty; default of 0.5 means equal weighting
     """
-    rule_count = 0
-    rule_count_body = 0
+    # the flat index of the rule whose body each rollout matches, or -1
+    matched = rule_set.match(query_relations, relation_trajectory)
+    body_matched = matched >= 0
+    complete_matched = body_matched & correct
+    rule_count_body = int(np.sum(body_matched))
+    rule_count = int(np.sum(complete_matched))
+    # the number of complete matches of each rule
+    rule_instances = np.bincount(matched[complete_matched], minlength=len(rule_set))
     if update_confs == 2 or update_confs == 3:
-        # to store the number of occurrences of each 2-hop chunk:
-        empirical_nums = init_empirical_nums(rule_list)
-    if update_confs == 1 or update_confs == 3:
-        # to store the number of occurrences of each rule:
-        no_rule_instances = {key: {i: 0 for i in range(len(val))} for key, val in rule_list.items()}
-    for k in range(len(obj_string)):
-        # get all of the relations/ rule heads applicable from k
-        query_rel = query_rel_string[k]
-        if query_rel in rule_list:
-            # get all rules in which that query_rel is the head
-            rel_rules = rule_list[query_rel]
-            argument_temp = [arguments[i][k] for i in range(len(arguments))]
-            # separate into relation sequence, last entity
-            body, obj = prepare_argument(argument_temp)
-            
-            for j in range(len(rel_rules)):
-                if check_rule(body, obj, obj_string[k], rel_rules[j], only_body=True):  # only checks if the metapath matches
-                    rule_count_body += 1
-
-                    if check_rule(body, obj, obj_string[k], rel_rules[j], only_body=False):  # checks if the last entity is a true sink node
-                        rule_count += 1
-                        if update_confs == 1 or update_confs == 3:
-                            # count the number of instances for each rule
-                            no_rule_instances[query_rel][j] += 1
-                        if update_confs == 2 or update_confs == 3:
-                            # get all of the 2-hop chunks that helped make a match
-                            empirical_nums = sum_dicts(empirical_nums, get_metapath_chunks(body))
-                    break
-
-            # now, loop through the metapaths and add a reward if the path matches metapath
-            # the rule added corresponds to the metapath confidence
-            for j in range(len(rel_rules)):  # for each rule body corresponding to that rule head:
-                if check_rule(body, obj, obj_string[k], rel_rules[j], only_body):
-                    # additional reward for matching rule body
-                    add_reward = Lambda * float(rel_rules[j][0])  # the 0th element is the confidence
-                    rewards[k] += add_reward
-                    break
+        # the number of occurrences of each 2-hop chunk in the complete matches
+        empirical_nums = rule_set.count_chunks(relation_trajectory[complete_matched])
+
+    # add a reward to the rollouts which match a rule, which corresponds to the metapath confidence
+    rewarded = body_matched if only_body else complete_matched
+    rewards[rewarded] += Lambda * rule_set.confidences[matched[rewarded]]
 
     print(f"Total bodies matched: {rule_count_body}")
     print(f"Total complete matches: {rule_count}")
@@ -282,38 +330,36 @@ def modify_rewards(rule_list, arguments, query_rel_string, obj_string, Lambda,
     if update_confs == 3:
         if rule_count <= 0:  # if no full metapath matches, just do the P2H update
             update_confs = 2
-        elif sum(empirical_nums.values()) <= 0:  # if no 2-hop chunks, just do the basic update
+        elif np.sum(empirical_nums) <= 0:  # if no 2-hop chunks, just do the basic update
             update_confs = 1
         else:
-            num_rules = len(sum([val for val in rule_list.values()], []))
+            num_rules = len(rule_set)
             min_ratio_naive = num_rules / (batch_size * rollouts)
             max_ratio_naive = num_rules * batch_size * rollouts
 
-            total_count = sum(empirical_nums.values())
-            empirical_probs = {key: val/total_count for key, val in empirical_nums.items()}
+            total_count = np.sum(empirical_nums)
+            empirical_probs = empirical_nums / total_count
             min_ratio_p2h = len(empirical_probs) / (batch_size * rollouts)
             max_ratio_p2h = len(empirical_probs) * batch_size * rollouts
 
-            rule_list = update_confs_mixed(rule_list, no_rule_instances, rule_count, empirical_probs, 
-                                                   alpha, min_ratio_naive, max_ratio_naive, 
-                                                   min_ratio_p2h, max_ratio_p2h, mixing_ratio)
+            update_confs_mixed(rule_set, rule_instances, rule_count, empirical_probs,
+                               alpha, min_ratio_naive, max_ratio_naive,
+                               min_ratio_p2h, max_ratio_p2h, mixing_ratio)
 
     # the naive / simple option
     if update_confs == 1 and rule_count > 0:
-        num_rules = len(sum([val for val in rule_list.values()], []))
+        num_rules = len(rule_set)
         min_ratio = num_rules / (batch_size * rollouts)
         max_ratio = num_rules * batch_size * rollouts
-        rule_list = update_confs_basic(rule_list, no_rule_instances, rule_count, alpha, min_ratio, max_ratio)
+        update_confs_basic(rule_set, rule_instances, rule_count, alpha, min_ratio, max_ratio)
 
     # the P2H option
     if update_confs == 2:
-        total_count = sum(empirical_nums.values())
+        total_count = np.sum(empirical_nums)
         if total_count > 0:
-            empirical_probs = {key: val/total_count for key, val in empirical_nums.items()}
+            empirical_probs = empirical_nums / total_count
             min_ratio = len(empirical_probs) / (batch_size * rollouts)
             max_ratio = len(empirical_probs) * batch_size * rollouts
-            rule_list = update_confs_P2H(rule_list, empirical_probs, alpha, min_ratio, max_ratio)
-
-    
+            update_confs_P2H(rule_set, empirical_probs, alpha, min_ratio, max_ratio)
 
-    return rewards, rule_count, rule_count_body, rule_list
+    return rewards, rule_count, rule_count_body
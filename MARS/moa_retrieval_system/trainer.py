@@ -11,14 +11,14 @@ import numpy as np
 from tqdm import tqdm
 from pprint import pprint
 from collections import defaultdict
-from copy import deepcopy
 from scipy.special import logsumexp as lse
 from sklearn.model_selection import ParameterGrid
 from MARS.options import read_options
 from MARS.moa_retrieval_system.agent import Agent
-from MARS.moa_retrieval_system.environment import Env
+from MARS.moa_retrieval_system.environment import Env, InGraphEnvironment
 from MARS.moa_retrieval_system.baseline import ReactiveBaseline
-from MARS.moa_retrieval_system.rules import prepare_argument, check_rule, modify_rewards
+from MARS.moa_retrieval_system.lazy_adam import LazyAdamOptimizer
+from MARS.moa_retrieval_system.rules import prepare_argument, modify_rewards, RuleSet
 
 import multiprocessing
 
@@ -36,17 +36,24 @@ class Trainer(object):
         # the trainer initializes an agent
         self.agent = Agent(params)
         self.train_environment = Env(params, 'train')
-        self.dev_test_environment = Env(params, 'dev')
-        self.test_test_environment = Env(params, 'test')
+        # the dev and test environments share the graph of the train environment instead of holding their own copies
+        self.dev_test_environment = Env(params, 'dev', grapher=self.train_environment.grapher)
+        self.test_test_environment = Env(params, 'test', grapher=self.train_environment.grapher)
         self.test_environment = self.dev_test_environment
         self.rev_entity_vocab = self.train_environment.grapher.rev_entity_vocab
         self.rev_relation_vocab = self.train_environment.grapher.rev_relation_vocab
         # load in the rules and corresponding confidences
         self.rule_list_dir = self.input_dir + self.rule_file
         with open(self.rule_list_dir, 'r') as file:
-            self.rule_list = json.load(file)
+            self.rule_set = RuleSet(json.load(file), self.relation_vocab, self.path_length)
         self.baseline = ReactiveBaseline(self.gamma_baseline)
-        self.optimizer = tf.compat.v1.train.AdamOptimizer(self.learning_rate)
+        if self.lazy_adam:
+            # only the rows of the embedding tables which are looked up in a batch are updated
+            self.optimizer = LazyAdamOptimizer(self.learning_rate)
+        else:
+            self.optimizer = tf.compat.v1.train.AdamOptimizer(self.learning_rate)
+        # whether the train batches are played and back-propagated in parts of micro_batch_size queries
+        self.micro_batches = 0 < self.micro_batch_size < self.batch_size
         self.best_metric = -1
         self.early_stopping = False
         self.current_patience = self.patience
@@ -62,12 +69,20 @@ class Trainer(object):
         self.tf_baseline = self.baseline.get_baseline_value()
 
         final_rewards = self.cum_discounted_rewards - self.tf_baseline
-        rewards_mean, rewards_var = tf.nn.moments(x=final_rewards, axes=[0, 1])
+        if self.micro_batches:
+            # the rewards of a micro-batch are normalized with the moments of the whole batch
+            rewards_mean, rewards_var = tf.unstack(self.reward_moments)
+        else:
+            rewards_mean, rewards_var = tf.nn.moments(x=final_rewards, axes=[0, 1])
         rewards_std = tf.sqrt(rewards_var) + 1e-6   # Constant added for numerical stability
         final_rewards = tf.compat.v1.div(final_rewards - rewards_mean, rewards_std)
 
         loss = tf.multiply(loss, final_rewards)
         total_loss = tf.reduce_mean(input_tensor=loss) - self.decaying_beta * self.entropy_reg_loss(self.per_example_logits)
+        if self.micro_batches:
+            # weighted by the share of the batch's rows, the losses (and gradients) of the micro-batches sum up to
+            # those of the whole batch
+            total_loss = total_loss * self.micro_batch_weight
         return total_loss
 
     def entropy_reg_loss(self, all_logits):
@@ -87,6 +102,9 @@ class Trainer(object):
         self.entity_sequence = []
         self.cum_discounted_rewards = tf.compat.v1.placeholder(tf.float32, [None, self.path_length],
                                                                name='cumulative_discounted_rewards')
+        if self.micro_batches:
+            self.reward_moments = tf.compat.v1.placeholder(tf.float32, [2], name='reward_moments')
+            self.micro_batch_weight = tf.compat.v1.placeholder(tf.float32, [], name='micro_batch_weight')
 
         # NOTE: params like path_length and max_branching come from the user-specified configs
         for t in range(self.path_length):
@@ -103,10 +121,17 @@ class Trainer(object):
             self.candidate_entity_sequence.append(next_possible_entities)
             self.entity_sequence.append(start_entities)
         
-        # here, the agent populates those lists and returns the final loss, scores, and action sequences
-        self.per_example_loss, self.per_example_logits, self.actions_idx = self.agent(
-            self.candidate_relation_sequence, self.candidate_entity_sequence, self.entity_sequence,
-            self.query_relations, self.range_arr, self.path_length)
+        if self.in_graph_env:
+            # the environment steps inside the TF graph, and the agent returns the chosen paths as well
+            self.in_graph_environment = InGraphEnvironment(self.train_environment.grapher, self.num_rollouts)
+            self.per_example_loss, self.per_example_logits, self.actions_idx, self.chosen_relations_sequence, \
+                self.chosen_entities_sequence = self.agent.rollout(self.in_graph_environment, self.query_relations,
+                                                                   self.range_arr, self.path_length)
+        else:
+            # here, the agent populates those lists and returns the final loss, scores, and action sequences
+            self.per_example_loss, self.per_example_logits, self.actions_idx = self.agent(
+                self.candidate_relation_sequence, self.candidate_entity_sequence, self.entity_sequence,
+                self.query_relations, self.range_arr, self.path_length)
 
         # calculate the final loss, including rewards
         self.loss_op = self.calc_reinforce_loss()
@@ -164,12 +189,72 @@ class Trainer(object):
         self.baseline.update(tf.reduce_mean(input_tensor=self.cum_discounted_rewards))
         tvars = tf.compat.v1.trainable_variables()
         grads = tf.gradients(ys=cost, xs=tvars)
-        grads, _ = tf.clip_by_global_norm(grads, self.grad_clip_norm)
+        global_norm = None
+        if self.micro_batches:
+            grads, global_norm = self.accumulate_gradients(grads, tvars)
+        grads, _ = tf.clip_by_global_norm(grads, self.grad_clip_norm, use_norm=global_norm)
         train_op = self.optimizer.apply_gradients(zip(grads, tvars))
         with tf.control_dependencies([train_op]):   # See https://github.com/tensorflow/tensorflow/issues/1899
             self.dummy = tf.constant(0)
         return train_op
 
+    def accumulate_gradients(self, grads, tvars):
+        """Creates variables which sum up the gradients of the micro-batches of a batch, with the ops to initialize
+        them (self.initialize_gradients_op), to add to them (self.accumulate_gradients_op) and to reset them to zero
+        (self.reset_gradients_op)
+        :returns: the summed gradients, and their global norm as clip_by_global_norm measures the gradients of the
+            whole batch. Gradients which are IndexedSlices stay IndexedSlices, of the rows touched by any micro-batch.
+        """
+        accumulators = []
+        summed_grads = []
+        accumulate_ops = []
+        reset_ops = []
+        squared_norms = []
+        # clip_by_global_norm measures the gradients of embedding lookups (IndexedSlices) by their values, with one
+        # value per lookup, so their squared norms add up over the micro-batches, unlike those of dense gradients
+        slices_squared_norms = []
+        with tf.compat.v1.variable_scope('gradient_accumulators'):
+            for grad, var in zip(grads, tvars):
+                if grad is None:
+                    summed_grads.append(None)
+                    continue
+                # local variables, so that they are neither saved with the model nor needed to restore it
+                accumulator = tf.compat.v1.Variable(tf.zeros(var.shape, dtype=var.dtype.base_dtype), trainable=False,
+                                                    collections=[tf.compat.v1.GraphKeys.LOCAL_VARIABLES])
+                accumulators.append(accumulator)
+                if isinstance(grad, tf.IndexedSlices):
+                    # marks the rows with a gradient, so that only those are passed on and reset
+                    touched = tf.compat.v1.Variable(tf.zeros(var.shape[:1], dtype=tf.bool), trainable=False,
+                                                    collections=[tf.compat.v1.GraphKeys.LOCAL_VARIABLES])
+                    accumulators.append(touched)
+                    accumulate_ops.append(accumulator.scatter_add(grad))
+                    accumulate_ops.append(touched.scatter_update(
+                        tf.IndexedSlices(tf.ones_like(grad.indices, dtype=tf.bool), grad.indices)))
+                    slices_squared_norms.append(tf.reduce_sum(input_tensor=tf.square(grad.values)))
+                    rows = tf.reshape(tf.compat.v1.where(touched), [-1])
+                    summed_grads.append(tf.IndexedSlices(tf.gather(accumulator, rows), rows,
+                                                         tf.shape(input=accumulator, out_type=tf.int64)))
+                    zero_rows = accumulator.scatter_update(
+                        tf.IndexedSlices(tf.zeros_like(summed_grads[-1].values), rows))
+                    with tf.control_dependencies([zero_rows]):
+                        reset_ops.append(touched.assign(tf.zeros_like(touched)))
+                else:
+                    accumulate_ops.append(accumulator.assign_add(grad))
+                    squared_norms.append(tf.reduce_sum(input_tensor=tf.square(accumulator)))
+                    summed_grads.append(accumulator.read_value())
+                    reset_ops.append(accumulator.assign(tf.zeros_like(accumulator)))
+            slices_squared_norm = tf.compat.v1.Variable(0.0, trainable=False,
+                                                        collections=[tf.compat.v1.GraphKeys.LOCAL_VARIABLES])
+            accumulators.append(slices_squared_norm)
+            if slices_squared_norms:
+                accumulate_ops.append(slices_squared_norm.assign_add(tf.add_n(slices_squared_norms)))
+            reset_ops.append(slices_squared_norm.assign(0.0))
+        self.initialize_gradients_op = tf.compat.v1.variables_initializer(accumulators)
+        self.accumulate_gradients_op = tf.group(*accumulate_ops)
+        self.reset_gradients_op = tf.group(*reset_ops)
+        global_norm = tf.sqrt(tf.add_n(squared_norms + [slices_squared_norm.read_value()]))
+        return summed_grads, global_norm
+
     def calc_cum_discounted_rewards(self, rewards):
         running_add = np.zeros([rewards.shape[0]])
         cum_disc_rewards = np.zeros([rewards.shape[0], self.path_length])
@@ -180,7 +265,21 @@ class Trainer(object):
         return cum_disc_rewards
 
     def io_setup(self):
-        fetches = self.per_example_loss + self.per_example_logits + self.actions_idx + [self.loss_op] + [self.dummy]
+        if self.in_graph_env:
+            if self.micro_batches:
+                # the micro-batches are only played here, and back-propagated later in their replays
+                fetches = self.chosen_relations_sequence + self.chosen_entities_sequence + self.actions_idx
+            else:
+                fetches = self.chosen_relations_sequence + self.chosen_entities_sequence + [self.loss_op] + [self.dummy]
+            feeds = [self.query_relations, self.range_arr, self.in_graph_environment.start_entities,
+                     self.in_graph_environment.end_entities, self.in_graph_environment.all_answers,
+                     self.cum_discounted_rewards]
+            feed_dict = {self.range_arr: np.arange(self.batch_size * self.num_rollouts)}
+            return fetches, feeds, feed_dict
+        if self.micro_batches:
+            fetches = self.actions_idx
+        else:
+            fetches = self.per_example_loss + self.per_example_logits + self.actions_idx + [self.loss_op] + [self.dummy]
         feeds = self.candidate_relation_sequence + self.candidate_entity_sequence + self.entity_sequence + \
                 [self.query_relations] + [self.range_arr] + [self.cum_discounted_rewards]
 
@@ -286,27 +385,23 @@ class Trainer(object):
     def rules_stats(self, b, r, qr, body, obj, ce, end_e, key_temp, test_rule_count_body, test_rule_count, rule_in_path,
                     is_correct, answer_pos_rule, pos_rule, seen_rule):
         rule_applied = False
-        if qr in self.rule_list:
-            rel_rules = self.rule_list[qr]
-            for j in range(len(rel_rules)):
-                if check_rule(body, obj, end_e, rel_rules[j], only_body=True):
-                    rule_applied = True
-                    rule_in_path = True
-                    test_rule_count_body[0] += 1
-                    if qr[0] == '_':
-                        test_rule_count_body[1] += 1
-                    else:
-                        test_rule_count_body[2] += 1
-                    if check_rule(body, obj, end_e, rel_rules[j], only_body=False):
-                        is_correct = True
-                        test_rule_count[0] += 1
-                        if qr[0] == '_':
-                            test_rule_count[1] += 1
-                        else:
-                            test_rule_count[2] += 1
-                        if answer_pos_rule is None:
-                            answer_pos_rule = pos_rule
-                    break
+        if self.rule_set.find(qr, body) >= 0:  # checks if the metapath matches the body of a rule of qr
+            rule_applied = True
+            rule_in_path = True
+            test_rule_count_body[0] += 1
+            if qr[0] == '_':
+                test_rule_count_body[1] += 1
+            else:
+                test_rule_count_body[2] += 1
+            if obj == end_e:  # checks if the last entity is a true sink node
+                is_correct = True
+                test_rule_count[0] += 1
+                if qr[0] == '_':
+                    test_rule_count[1] += 1
+                else:
+                    test_rule_count[2] += 1
+                if answer_pos_rule is None:
+                    answer_pos_rule = pos_rule
         if (ce[b, r] not in seen_rule) and rule_applied:
             seen_rule.add(ce[b, r])
             pos_rule += 1
@@ -472,59 +567,187 @@ class Trainer(object):
             scores_file.write('\n')
             scores_file.write('\n')
 
+    def rollout(self, sess, episode, fetches, feeds, feed_dict):
+        """Lets the agent find paths for one episode, feeding the states of the environment to the TF graph at every hop
+        :returns: the partial run handle, the [rollouts, path_length] array of the chosen relations, the last entity,
+            query relation and query object of every rollout, and the rewards
+        """
+        # parallelization
+        h = sess.partial_run_setup(fetches=fetches, feeds=feeds)
+        # get all the next relations from query
+        feed_dict[0][self.query_relations] = episode.get_query_relations()
+        states = episode.get_states()
+
+        relation_trajectory = []
+        # here is where the agent finds a path between the query and the answer
+        for i in range(self.path_length):
+            feed_dict[i][self.candidate_relation_sequence[i]] = states['next_relations']
+            feed_dict[i][self.candidate_entity_sequence[i]] = states['next_entities']
+            feed_dict[i][self.entity_sequence[i]] = states['current_entities']
+            per_example_loss, per_example_logits, actions_idx = sess.partial_run(
+                h, [self.per_example_loss[i], self.per_example_logits[i], self.actions_idx[i]],
+                feed_dict=feed_dict[i])
+
+            relation_trajectory.append(states['next_relations'][np.arange(actions_idx.shape[0]), actions_idx])
+            # get the next set of states
+            states = episode(actions_idx)
+
+        # positive or negative reward values per starting node
+        return h, np.stack(relation_trajectory, axis=1), states['current_entities'], episode.get_query_relations(), \
+            episode.get_query_objects(), episode.get_rewards()
+
+    def micro_batch_parts(self, num_queries):
+        """Splits a batch into micro-batches of whole queries
+        :returns: for each micro-batch, the slice of its queries and the slice of their rows (one per rollout)
+        """
+        return [(slice(start, start + self.micro_batch_size),
+                 slice(start * self.num_rollouts, (start + self.micro_batch_size) * self.num_rollouts))
+                for start in range(0, num_queries, self.micro_batch_size)]
+
+    def rollout_micro_batches(self, sess, episode, fetches, feeds):
+        """Like rollout, but every hop is played one micro-batch at a time, each micro-batch in its own partial run,
+            so that the model never holds the tensors of more than one micro-batch. No gradients are computed yet.
+        :returns: the same as rollout, but instead of the partial run handle, the feed dicts with which each
+            micro-batch is replayed by backprop
+        """
+        parts = self.micro_batch_parts(episode.no_examples)
+        handles = [sess.partial_run_setup(fetches=fetches, feeds=feeds) for _ in parts]
+        query_relations = episode.get_query_relations()
+        replay_feed_dicts = [{self.query_relations: query_relations[rows],
+                              self.range_arr: np.arange(query_relations[rows].shape[0])} for _, rows in parts]
+        states = episode.get_states()
+
+        relation_trajectory = []
+        for i in range(self.path_length):
+            actions_idx = []
+            for h, (_, rows), replay_feed_dict in zip(handles, parts, replay_feed_dicts):
+                feed_dict = {self.candidate_relation_sequence[i]: states['next_relations'][rows],
+                             self.candidate_entity_sequence[i]: states['next_entities'][rows],
+                             self.entity_sequence[i]: states['current_entities'][rows]}
+                if i == 0:
+                    feed_dict[self.query_relations] = replay_feed_dict[self.query_relations]
+                    feed_dict[self.range_arr] = replay_feed_dict[self.range_arr]
+                actions_idx.append(sess.partial_run(h, self.actions_idx[i], feed_dict=feed_dict))
+                # the replay feeds the same states, and the chosen actions instead of sampling new ones
+                replay_feed_dict.update(feed_dict)
+                replay_feed_dict[self.actions_idx[i]] = actions_idx[-1]
+            actions_idx = np.concatenate(actions_idx)
+            relation_trajectory.append(states['next_relations'][np.arange(actions_idx.shape[0]), actions_idx])
+            states = episode(actions_idx)
+
+        return replay_feed_dicts, np.stack(relation_trajectory, axis=1), states['current_entities'], query_relations, \
+            episode.get_query_objects(), episode.get_rewards()
+
+    def rollout_in_graph(self, sess, data, fetches, feeds, feed_dict):
+        """Lets the agent find paths for one batch in one session call, with the environment stepping in the TF graph
+        :param data: a batch of the train batcher
+        :returns: the same as rollout
+        """
+        start_entities, query_relations, end_entities, all_answers = data
+        query_relations = np.repeat(query_relations, self.num_rollouts)
+        end_entities = np.repeat(end_entities, self.num_rollouts)
+        h = sess.partial_run_setup(fetches=fetches, feeds=feeds)
+        feed_dict[self.query_relations] = query_relations
+        feed_dict[self.in_graph_environment.start_entities] = np.repeat(start_entities, self.num_rollouts)
+        feed_dict[self.in_graph_environment.end_entities] = end_entities
+        feed_dict[self.in_graph_environment.all_answers] = all_answers
+        chosen = sess.partial_run(h, self.chosen_relations_sequence + self.chosen_entities_sequence,
+                                  feed_dict=feed_dict)
+
+        # positive or negative reward values per starting node, depending on whether the last hop found the sink node
+        rewards = np.where(chosen[-1] == end_entities, self.positive_reward, self.negative_reward)
+        return h, np.stack(chosen[:self.path_length], axis=1), chosen[-1], query_relations, end_entities, rewards
+
+    def rollout_in_graph_micro_batches(self, sess, data, fetches):
+        """Like rollout_in_graph, but the batch is played one micro-batch at a time, without computing gradients yet
+        :returns: the same as rollout_micro_batches
+        """
+        start_entities, query_relations, end_entities, all_answers = data
+        chosen = [[] for _ in range(2 * self.path_length)]
+        replay_feed_dicts = []
+        for queries, _ in self.micro_batch_parts(start_entities.shape[0]):
+            feed_dict = {self.query_relations: np.repeat(query_relations[queries], self.num_rollouts),
+                         self.in_graph_environment.start_entities: np.repeat(start_entities[queries], self.num_rollouts),
+                         self.in_graph_environment.end_entities: np.repeat(end_entities[queries], self.num_rollouts),
+                         self.in_graph_environment.all_answers: all_answers[queries]}
+            feed_dict[self.range_arr] = np.arange(feed_dict[self.query_relations].shape[0])
+            outputs = sess.run(fetches, feed_dict=feed_dict)
+            for hop, output in enumerate(outputs[:2 * self.path_length]):
+                chosen[hop].append(output)
+            # the replay follows the same paths, as the chosen actions are fed instead of sampling new ones
+            feed_dict.update(zip(self.actions_idx, outputs[2 * self.path_length:]))
+            replay_feed_dicts.append(feed_dict)
+        chosen = [np.concatenate(output) for output in chosen]
+
+        query_relations = np.repeat(query_relations, self.num_rollouts)
+        end_entities = np.repeat(end_entities, self.num_rollouts)
+        rewards = np.where(chosen[-1] == end_entities, self.positive_reward, self.negative_reward)
+        return replay_feed_dicts, np.stack(chosen[:self.path_length], axis=1), chosen[-1], query_relations, \
+            end_entities, rewards
+
+    def backprop(self, sess, h, cum_discounted_rewards):
+        """Updates the model with the rewards of a batch
+        :param h: the partial run handle of the rollout, or with micro-batches, the feed dicts of their replays
+        :returns: the loss of the batch
+        """
+        if not self.micro_batches:
+            batch_total_loss, _ = sess.partial_run(h, [self.loss_op, self.dummy],
+                                                   feed_dict={self.cum_discounted_rewards: cum_discounted_rewards})
+            return batch_total_loss
+
+        # the moments with which calc_reinforce_loss normalizes the rewards of the whole batch
+        final_rewards = cum_discounted_rewards.astype(np.float32) - sess.run(self.tf_baseline)
+        reward_moments = np.array([np.mean(final_rewards), np.var(final_rewards)])
+        batch_total_loss = 0.0
+        start = 0
+        for feed_dict in h:
+            rows = feed_dict[self.range_arr].shape[0]
+            feed_dict[self.cum_discounted_rewards] = cum_discounted_rewards[start:start + rows]
+            feed_dict[self.reward_moments] = reward_moments
+            feed_dict[self.micro_batch_weight] = rows / cum_discounted_rewards.shape[0]
+            loss, _ = sess.run([self.loss_op, self.accumulate_gradients_op], feed_dict=feed_dict)
+            batch_total_loss += loss
+            start += rows
+        # a single update with the summed gradients
+        sess.run(self.dummy)
+        sess.run(self.reset_gradients_op)
+        return batch_total_loss
+
     def train(self, sess):
         fetches, feeds, feed_dict = self.io_setup()
         train_loss = 0.0
         self.batch_counter = 0
+        if self.micro_batches:
+            sess.run(self.initialize_gradients_op)
+        if self.in_graph_env:
+            self.in_graph_environment.initialize(sess)
+            batches = self.train_environment.batcher.yield_next_batch_train()
+        else:
+            batches = self.train_environment.get_episodes()
 
         # for each batch / episode
-        for episode in self.train_environment.get_episodes():
+        for episode in batches:
             self.batch_counter += 1
-            # parallelization
-            h = sess.partial_run_setup(fetches=fetches, feeds=feeds)
-            # get all the next relations from query
-            feed_dict[0][self.query_relations] = episode.get_query_relations()
-            states = episode.get_states()
+            if self.in_graph_env and self.micro_batches:
+                rollout = self.rollout_in_graph_micro_batches(sess, episode, fetches)
+            elif self.in_graph_env:
+                rollout = self.rollout_in_graph(sess, episode, fetches, feeds, feed_dict)
+            elif self.micro_batches:
+                rollout = self.rollout_micro_batches(sess, episode, fetches, feeds)
+            else:
+                rollout = self.rollout(sess, episode, fetches, feeds, feed_dict)
+            h, relation_trajectory, last_entities, query_relations, query_objects, rewards = rollout
 
-            arguments = []
-            # here is where the agent finds a path between the query and the answer
-            for i in range(self.path_length):
-                feed_dict[i][self.candidate_relation_sequence[i]] = states['next_relations']
-                feed_dict[i][self.candidate_entity_sequence[i]] = states['next_entities']
-                feed_dict[i][self.entity_sequence[i]] = states['current_entities']
-                per_example_loss, per_example_logits, actions_idx = sess.partial_run(
-                    h, [self.per_example_loss[i], self.per_example_logits[i], self.actions_idx[i]],
-                    feed_dict=feed_dict[i])
-
-                rel = np.copy(states['next_relations'][np.arange(states['next_relations'].shape[0]), actions_idx])
-                ent = np.copy(states['next_entities'][np.arange(states['next_entities'].shape[0]), actions_idx])
-                # get the names of the relations and entities from the IDs
-                rel_string = np.array([self.rev_relation_vocab[x] for x in rel])
-                ent_string = np.array([self.rev_entity_vocab[x] for x in ent])
-                # rel_string and ent_string are actually lists of possibilities from the current state
-                arguments.append(rel_string)
-                arguments.append(ent_string)
-                # get the next set of states
-                states = episode(actions_idx)
-
-            # all relations
-            query_rel_string = np.array([self.rev_relation_vocab[x] for x in episode.get_query_relations()])
-            # all sink nodes
-            obj_string = np.array([self.rev_entity_vocab[x] for x in episode.get_query_objects()])
-
-            # positive or negative reward values per starting node
-            rewards = episode.get_rewards()
             # Here, they modify the rewards to take into account whether it fits rules.
-            rewards, rule_count, rule_count_body, self.rule_list = modify_rewards(deepcopy(self.rule_list), arguments, query_rel_string,
-                                                                            obj_string, self.Lambda, rewards,
-                                                                            self.only_body, self.update_confs, self.alpha,
-                                                                            self.batch_size, self.num_rollouts, self.mixing_ratio)
+            rewards, rule_count, rule_count_body = modify_rewards(self.rule_set, query_relations, relation_trajectory,
+                                                                  last_entities == query_objects, self.Lambda, rewards,
+                                                                  self.only_body, self.update_confs, self.alpha,
+                                                                  self.batch_size, self.num_rollouts, self.mixing_ratio)
             
             cum_discounted_rewards = self.calc_cum_discounted_rewards(rewards)
 
             # Backpropagation
-            batch_total_loss, _ = sess.partial_run(h, [self.loss_op, self.dummy],
-                                                   feed_dict={self.cum_discounted_rewards: cum_discounted_rewards})
+            batch_total_loss = self.backprop(sess, h, cum_discounted_rewards)
 
             # Print statistics
             train_loss = 0.98 * train_loss + 0.02 * batch_total_loss
@@ -546,12 +769,18 @@ class Trainer(object):
             logger.info('rule_count_correct: {0}/{1} = {2:6.4f}'.format(
                 rule_count, self.batch_size * self.num_rollouts,
                 rule_count / (self.batch_size * self.num_rollouts)))
+            if not self.in_graph_env:
+                # the next actions are only computed for the unique (query, entity) pairs among the rollouts
+                logger.info('unique_action_rows: {0}/{1} = {2:6.4f}'.format(
+                    episode.unique_action_rows, episode.action_rows, episode.unique_action_rows / episode.action_rows))
 
             if self.batch_counter % self.eval_every == 0:  ## validation / dev set testing
+                if self.train_environment.prefetcher is not None:
+                    logger.info(self.train_environment.prefetcher.report())
                 with open(self.output_dir + 'scores.txt', 'a') as score_file:
                     score_file.write('Scores for iteration ' + str(self.batch_counter) + '\n')
                 with open(self.output_dir + f'confidences_{self.batch_counter}.txt', 'w') as rule_fl:
-                    json.dump(self.rule_list, rule_fl, indent=2)
+                    json.dump(self.rule_set.to_dict(), rule_fl, indent=2)
                 paths_log_dir = self.output_dir + str(self.batch_counter) + '/'
                 os.makedirs(paths_log_dir)
                 self.paths_log = paths_log_dir + 'paths'
@@ -562,11 +791,11 @@ class Trainer(object):
 
             if self.early_stopping:
                 with open(self.output_dir + 'confidences.txt', 'w') as rule_fl:
-                    json.dump(self.rule_list, rule_fl, indent=2)
+                    json.dump(self.rule_set.to_dict(), rule_fl, indent=2)
                 break
             if self.batch_counter >= self.total_iterations:
                 with open(self.output_dir + 'confidences.txt', 'w') as rule_fl:
-                    json.dump(self.rule_list, rule_fl, indent=2)
+                    json.dump(self.rule_set.to_dict(), rule_fl, indent=2)
                 break
 
     def test(self, sess, print_paths=False, save_model=True, beam=True):
@@ -713,9 +942,11 @@ class Trainer(object):
         metrics_rule = ['Hits@1_rule', 'Hits@3_rule', 'Hits@5_rule', 'Hits@10_rule', 'Hits@20_rule', 'MRR_rule']
         for i in range(len(metrics_rule)):
             logger.info(metrics_rule[i] + ': {0:7.4f}'.format(final_metrics_rule[i]))
+        if self.test_environment.prefetcher is not None:
+            logger.info(self.test_environment.prefetcher.report())
 
         with open(self.output_dir + 'confidences.txt', 'w') as rule_fl:
-            json.dump(self.rule_list, rule_fl, indent=2)
+            json.dump(self.rule_set.to_dict(), rule_fl, indent=2)
 
 
 def create_output_and_model_dir(params, mode):
@@ -38,6 +38,14 @@ def read_options():
     parser.add_argument('--alpha', default=0.1, type=float, nargs='+')
     parser.add_argument('--mixing_ratio', default=0.5, type=float, nargs='+')
     parser.add_argument('--class_threshhold', default=None, type=int, nargs='+')
+    parser.add_argument('--graph_cache_dir', default='', type=str)
+    parser.add_argument('--derive_inverses', default=0, type=int)
+    parser.add_argument('--prefetch_depth', default=2, type=int)
+    parser.add_argument('--in_graph_env', default=0, type=int)
+    parser.add_argument('--micro_batch_size', default=0, type=int)
+    parser.add_argument('--factorized_scoring', default=0, type=int)
+    parser.add_argument('--dedup_rollouts', default=0, type=int)
+    parser.add_argument('--lazy_adam', default=0, type=int)
 
     try:
         parsed = vars(parser.parse_args())
@@ -47,6 +55,11 @@ def read_options():
     parsed['use_entity_embeddings'] = (parsed['use_entity_embeddings'] == 1)
     parsed['train_entity_embeddings'] = (parsed['train_entity_embeddings'] == 1)
     parsed['train_relation_embeddings'] = (parsed['train_relation_embeddings'] == 1)
+    parsed['derive_inverses'] = (parsed['derive_inverses'] == 1)
+    parsed['in_graph_env'] = (parsed['in_graph_env'] == 1)
+    parsed['factorized_scoring'] = (parsed['factorized_scoring'] == 1)
+    parsed['dedup_rollouts'] = (parsed['dedup_rollouts'] == 1)
+    parsed['lazy_adam'] = (parsed['lazy_adam'] == 1)
 
     if parsed['pretrained_embeddings_dir'] != '':
         parsed['pretrained_embeddings_relation'] = parsed['pretrained_embeddings_dir'] + 'relation_embeddings.npy'